@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#analise de audio com numpy para as ferramentas de fases (bpm_tool.py):
+#fluxo espectral (onsets), BPM por autocorrelacao e fase da primeira batida
+
+import numpy as np
+
+import audio
+
+FRAME_SIZE = 2048
+HOP_SIZE = 512
+
+#quadros processados por vez na FFT, para limitar a memoria usada
+FFT_BLOCK = 1024
+
+MIN_BPM = 60.0
+MAX_BPM = 200.0
+
+#audio decodificado (audio.decode) como float32 mono em [-1, 1]
+def load_mono(path):
+    decoded = audio.decode(path)
+    samples = np.frombuffer(decoded.data.getMessage(), dtype='<i2').astype(np.float32)/32768.0
+    samples = samples[:len(samples) - len(samples) % decoded.channels]
+    return samples.reshape(-1, decoded.channels).mean(axis=1), decoded.rate
+
+#quadros por segundo do envelope
+def frame_rate(rate):
+    return float(rate)/HOP_SIZE
+
+#instante (s) correspondente a cada quadro: o centro da janela
+def frame_times(n_frames, rate):
+    return (np.arange(n_frames)*HOP_SIZE + FRAME_SIZE/2.0)/rate
+
+#fluxo espectral (aumento da energia log) por quadro, opcionalmente separado por
+#faixas de frequencia (bands = lista de (hz_min, hz_max)); calculado em blocos de
+#FFT_BLOCK quadros e com a media movel subtraida, para ficar so com os picos
+def spectral_flux(samples, rate, bands=None, smooth=0.5):
+    if len(samples) < FRAME_SIZE:
+        samples = np.pad(samples, (0, FRAME_SIZE - len(samples)))
+    n_frames = 1 + (len(samples) - FRAME_SIZE)//HOP_SIZE
+    frames = np.lib.stride_tricks.as_strided(samples, shape=(n_frames, FRAME_SIZE),
+                                             strides=(samples.strides[0]*HOP_SIZE, samples.strides[0]))
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+
+    freqs = np.fft.rfftfreq(FRAME_SIZE, 1.0/rate)
+    if bands is None:
+        masks = [np.ones(len(freqs), dtype=bool)]
+    else:
+        masks = [(freqs >= lo) & (freqs < hi) for lo, hi in bands]
+
+    flux = np.zeros((n_frames, len(masks)), dtype=np.float32)
+    last = None
+    for start in range(0, n_frames, FFT_BLOCK):
+        log_mag = np.log1p(100.0*np.abs(np.fft.rfft(frames[start:start + FFT_BLOCK]*window, axis=1)))
+        if last is None:
+            last = log_mag[:1]
+        rise = np.maximum(np.diff(np.vstack([last, log_mag]), axis=0), 0.0)
+        for b, mask in enumerate(masks):
+            flux[start:start + len(rise), b] = rise[:, mask].sum(axis=1)
+        last = log_mag[-1:]
+
+    width = max(1, int(smooth*frame_rate(rate)))
+    kernel = np.ones(width)/width
+    for b in range(len(masks)):
+        flux[:, b] = np.maximum(flux[:, b] - np.convolve(flux[:, b], kernel, mode='same'), 0.0)
+
+    if bands is None:
+        return flux[:, 0]
+    return flux
+
+def onset_envelope(samples, rate):
+    return spectral_flux(samples, rate)
+
+#autocorrelacao via FFT, normalizada pelo lag 0
+def autocorrelation(env):
+    env = env - env.mean()
+    n = len(env)
+    spec = np.fft.rfft(env, 2*n)
+    acf = np.fft.irfft(spec*np.conj(spec))[:n]
+    if acf[0] > 0:
+        acf = acf/acf[0]
+    return acf
+
+#BPM: pico grosso da autocorrelacao dentro de [min_bpm, max_bpm], refinado somando
+#a autocorrelacao nos multiplos do periodo (lags longos dao resolucao fina)
+def estimate_bpm(env, rate, min_bpm=MIN_BPM, max_bpm=MAX_BPM, n_multiples=16, step=0.01):
+    fps = frame_rate(rate)
+    acf = autocorrelation(env)
+    lags = np.arange(len(acf))
+
+    min_lag = int(60.0*fps/max_bpm)
+    max_lag = min(int(60.0*fps/min_bpm) + 1, len(acf) - 1)
+    if max_lag <= min_lag:
+        raise ValueError("Audio too short to estimate the tempo")
+
+    coarse_lag = min_lag + np.argmax(acf[min_lag:max_lag])
+    coarse_bpm = 60.0*fps/coarse_lag
+
+    #candidatos em torno do pico grosso (+- um quadro de lag)
+    lo = 60.0*fps/(coarse_lag + 1)
+    hi = 60.0*fps/max(coarse_lag - 1, 1)
+    candidates = np.arange(lo, hi, step)
+    if not len(candidates):
+        return coarse_bpm
+
+    multiples = np.arange(1, n_multiples + 1)
+    periods = 60.0*fps/candidates
+    sample_lags = periods[:, None]*multiples[None, :]
+    valid = sample_lags < len(acf) - 1
+    scores = np.where(valid, np.interp(sample_lags, lags, acf), 0.0).sum(axis=1)
+
+    return float(candidates[np.argmax(scores)])
+
+#fase (s) da primeira batida: o deslocamento em [0, periodo) que maximiza a soma
+#do envelope nas batidas
+def estimate_offset(env, rate, bpm, resolution=0.002):
+    period = 60.0/bpm
+    times = frame_times(len(env), rate)
+
+    phases = np.arange(0.0, period, resolution)
+    n_beats = int((times[-1] - times[0])/period)
+    beat_times = phases[:, None] + period*np.arange(n_beats)[None, :]
+    scores = np.interp(beat_times, times, env, left=0.0, right=0.0).sum(axis=1)
+
+    return float(phases[np.argmax(scores)])
+
+def analyze_tempo(path, min_bpm=MIN_BPM, max_bpm=MAX_BPM):
+    samples, rate = load_mono(path)
+    env = onset_envelope(samples, rate)
+    bpm = estimate_bpm(env, rate, min_bpm, max_bpm)
+    return bpm, estimate_offset(env, rate, bpm)
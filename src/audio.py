@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import wave
+import threading
+import collections
+
+from direct.task import Task
+from panda3d.core import *
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#musicas decodificadas para PCM numa thread propria e mantidas em memoria
+#(LRU, limitado por audio-cache-mb no config.prc); tocar uma musica ja
+#decodificada eh so entregar o buffer ao gerenciador de audio, sem abrir o decoder
+
+AUDIO_CACHE_MB = ConfigVariableInt('audio-cache-mb', 192, "Memory budget (MB) for decoded songs kept in memory")
+
+#amostras lidas por vez do decoder
+DECODE_CHUNK = 65536
+
+#vozes pre-alocadas por efeito sonoro (ver SfxVoices)
+SFX_VOICES = ConfigVariableInt('sfx-voices', 4, "Voices preallocated per sound effect")
+
+#espera maxima (s) pela decodificacao na thread principal, curta para nao travar
+#o jogo; depois disso a musica toca pelo loader normal (como antes do cache) e a
+#versao decodificada fica para a proxima vez
+DECODE_WAIT = ConfigVariableDouble('audio-decode-wait', 0.1, "Seconds to wait for a song being decoded before streaming it instead")
+
+#musicas mais longas do que isso (ou de duracao desconhecida) nao sao decodificadas
+MAX_DECODE_LENGTH = 3600.0
+
+#previas da selecao de fases: trecho de PREVIEW_LENGTH segundos comecando em
+#PREVIEW no header.lvl ou, sem ele, a PREVIEW_POSITION da duracao da musica
+PREVIEW_CACHE_DIR = './cache/previews'
+PREVIEW_LENGTH = 15.0
+PREVIEW_POSITION = 0.35
+#previas mantidas na memoria, para voltar a uma fase ja ouvida sem ler o disco
+PREVIEW_MEMORY = 8
+
+#musicas com a velocidade alterada (treino), por velocidade
+STRETCH_CACHE_DIR = './cache/stretch'
+#quadro e deslocamento maximo (amostras) da busca do WSOLA
+WSOLA_FRAME = 1024
+WSOLA_TOLERANCE = 256
+
+#PCM 16 bits intercalado de uma musica
+class DecodedAudio:
+    def __init__(self, path, rate, channels, data):
+        self.path = path
+        self.rate = rate
+        self.channels = channels
+        self.data = data
+
+    def size(self):
+        return self.data.getLength()
+
+    #fonte tocando a partir de start segundos; uma UserDataAudio so pode ter um
+    #cursor aberto, entao cada AudioSound precisa da sua
+    def make_source(self, start=0.0):
+        offset = min(int(start*self.rate)*self.channels*2, self.data.getLength())
+        source = UserDataAudio(self.rate, self.channels, False)
+        source.append(DatagramIterator(self.data, offset), self.data.getLength() - offset)
+        source.done()
+        return source
+
+def decode(path):
+    cursor = MovieAudio.get(Filename(path)).open()
+    if cursor is None:
+        raise IOError("Could not open audio file '%s'" % path)
+
+    length = cursor.length()
+    if length <= 0 or length > MAX_DECODE_LENGTH:
+        raise IOError("Could not decode '%s': unknown or too long duration" % path)
+
+    return DecodedAudio(path, cursor.audioRate(), cursor.audioChannels(), read_samples(cursor, length))
+
+def read_samples(cursor, length):
+    data = Datagram()
+    remaining = int(length*cursor.audioRate())
+    while remaining > 0:
+        n = min(DECODE_CHUNK, remaining)
+        cursor.readSamples(n, data)
+        remaining -= n
+    return data
+
+#decodifica so o trecho [start, start + length): o cursor pula direto para start
+#pelo seek do decoder, sem decodificar o comeco da musica
+def decode_segment(path, start, length):
+    cursor = MovieAudio.get(Filename(path)).open()
+    if cursor is None:
+        raise IOError("Could not open audio file '%s'" % path)
+
+    total = cursor.length()
+    if start is None:
+        start = total*PREVIEW_POSITION if total > 0 else 0.0
+    if total > 0:
+        start = max(0.0, min(start, total - length))
+
+    if start > 0:
+        if cursor.canSeek():
+            cursor.seek(start)
+        else:
+            cursor.skipSamples(int(start*cursor.audioRate()))
+
+    return DecodedAudio(path, cursor.audioRate(), cursor.audioChannels(), read_samples(cursor, length))
+
+def write_wav(path, decoded):
+    tmp = path + '.tmp'
+    f = wave.open(tmp, 'wb')
+    try:
+        f.setnchannels(decoded.channels)
+        f.setsampwidth(2)
+        f.setframerate(decoded.rate)
+        f.writeframes(decoded.data.getMessage())
+    finally:
+        f.close()
+    os.replace(tmp, path)
+
+def read_wav(path):
+    f = wave.open(path, 'rb')
+    try:
+        return DecodedAudio(path, f.getframerate(), f.getnchannels(), Datagram(f.readframes(f.getnframes())))
+    finally:
+        f.close()
+
+#WSOLA: quadros de WSOLA_FRAME amostras com janela de Hann somados a cada meio
+#quadro na saida e lidos perto de i*meio quadro*rate na entrada, no deslocamento
+#(ate WSOLA_TOLERANCE) mais parecido com a continuacao natural do quadro anterior;
+#muda a duracao por 1/rate sem mudar a altura
+def time_stretch(decoded, rate):
+    if np is None:
+        raise IOError("NumPy is needed to change the speed of '%s'" % decoded.path)
+    
+    samples = np.frombuffer(decoded.data.getMessage(), dtype='<i2').astype(np.float32)
+    samples = samples[:len(samples) - len(samples) % decoded.channels].reshape(-1, decoded.channels)
+    
+    frame, tol = WSOLA_FRAME, WSOLA_TOLERANCE
+    syn_hop = frame//2
+    ana_hop = syn_hop*rate
+    pad = 2*(frame + tol)
+    x = np.pad(samples, ((pad, pad), (0, 0)))
+    mono = x.mean(axis=1)
+    window = np.hanning(frame).astype(np.float32)
+    
+    n_out = int(len(samples)/rate)
+    n_frames = n_out//syn_hop + 1
+    out = np.zeros((n_frames*syn_hop + frame, decoded.channels), dtype=np.float32)
+    norm = np.zeros(len(out), dtype=np.float32)
+    
+    #correlacao pela FFT, com tamanho suficiente para nao dar a volta
+    n_fft = 1
+    while n_fft < 2*(frame + tol):
+        n_fft *= 2
+    
+    delta = 0
+    for i in range(n_frames):
+        src = pad + int(round(i*ana_hop)) + delta
+        dst = i*syn_hop
+        out[dst:dst + frame] += x[src:src + frame]*window[:, None]
+        norm[dst:dst + frame] += window
+        
+        natural = mono[src + syn_hop:src + syn_hop + frame]
+        start = pad + int(round((i + 1)*ana_hop)) - tol
+        region = mono[start:start + frame + 2*tol]
+        corr = np.fft.irfft(np.fft.rfft(region, n_fft)*np.conj(np.fft.rfft(natural, n_fft)), n_fft)
+        delta = int(np.argmax(corr[:2*tol + 1])) - tol
+    
+    out = out[:n_out]/np.maximum(norm[:n_out], 1e-3)[:, None]
+    pcm = np.clip(out, -32768, 32767).astype('<i2')
+    return DecodedAudio(decoded.path, decoded.rate, decoded.channels, Datagram(pcm.tobytes()))
+
+def cache_name(path, suffix):
+    return "%s%s.wav" % (os.path.normpath(path).replace(os.sep, '_'), suffix)
+
+#le o WAV em cache de path se ele for mais novo que a musica
+def read_cached(cached, path):
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+        try:
+            return read_wav(cached)
+        except (IOError, EOFError, wave.Error):
+            pass
+    return None
+
+def write_cached(cache_dir, cached, decoded):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    write_wav(cached, decoded)
+
+#previa de path, do cache em disco (WAV) ou decodificada e gravada nele
+def load_preview(path, start=None):
+    if start is None:
+        cached = os.path.join(PREVIEW_CACHE_DIR, cache_name(path, ''))
+    else:
+        cached = os.path.join(PREVIEW_CACHE_DIR, cache_name(path, '_%d' % int(start*1000)))
+    
+    decoded = read_cached(cached, path)
+    if decoded is None:
+        decoded = decode_segment(path, start, PREVIEW_LENGTH)
+        write_cached(PREVIEW_CACHE_DIR, cached, decoded)
+    return decoded
+
+#N vozes (AudioSounds do mesmo arquivo, que compartilham o buffer) tocadas em
+#rodizio; se todas estiverem tocando, a mais antiga eh interrompida e reaproveitada
+class SfxVoices:
+    def __init__(self, path, n_voices):
+        self.voices = [loader.loadSfx(path) for i in range(n_voices)]
+        self.next_voice = 0
+
+    def play(self):
+        voice = self.voices[self.next_voice]
+        self.next_voice = (self.next_voice + 1) % len(self.voices)
+
+        if voice.status() == AudioSound.PLAYING:
+            voice.stop()
+        voice.play()
+        return voice
+
+    def setVolume(self, volume):
+        for voice in self.voices:
+            voice.setVolume(volume)
+
+class AudioCache:
+    def __init__(self):
+        self.budget = AUDIO_CACHE_MB.getValue()*1024*1024
+        self.used = 0
+        self.songs = collections.OrderedDict()
+        self.sfx = {}
+        self.sfx_voices = {}
+
+        self.pending = {}
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, name='audio-decoder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    #comeca a decodificar em segundo plano, se ainda nao estiver na memoria; com
+    #rate != 1 a musica tambem eh esticada para tocar rate vezes mais rapido
+    def prefetch(self, path, rate=1.0):
+        key = (path, rate)
+        with self.cond:
+            if key in self.songs or key in self.pending:
+                return
+            self.pending[key] = threading.Event()
+            self.queue.append(key)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                key = self.queue.popleft()
+
+            #qualquer erro apenas descarta a musica; o evento eh sempre liberado,
+            #para ninguem ficar esperando por ela
+            decoded = None
+            try:
+                path, rate = key
+                if rate == 1.0:
+                    decoded = decode(path)
+                else:
+                    decoded = self.stretch(path, rate)
+            except Exception as e:
+                print("Could not decode '%s' at rate %.2f: %s" % (key[0], key[1], e))
+            finally:
+                with self.cond:
+                    if decoded is not None:
+                        self.store(key, decoded)
+                    self.pending.pop(key).set()
+
+    #executado na thread; usa a versao normal da memoria se houver e guarda o
+    #resultado em disco, uma copia por velocidade
+    def stretch(self, path, rate):
+        cached = os.path.join(STRETCH_CACHE_DIR, cache_name(path, '_%d' % round(rate*100)))
+        stretched = read_cached(cached, path)
+        if stretched is not None:
+            return stretched
+
+        with self.cond:
+            decoded = self.songs.get((path, 1.0))
+        if decoded is None:
+            decoded = decode(path)
+
+        stretched = time_stretch(decoded, rate)
+        write_cached(STRETCH_CACHE_DIR, cached, stretched)
+        return stretched
+
+    #chamado com o lock; descarta as musicas usadas ha mais tempo ate caber no orcamento
+    def store(self, key, decoded):
+        self.songs[key] = decoded
+        self.used += decoded.size()
+
+        while self.used > self.budget and len(self.songs) > 1:
+            old_path, old = self.songs.popitem(last=False)
+            self.used -= old.size()
+
+    #AudioSound da musica tocando a partir da memoria; espera a decodificacao se
+    #ela estiver em andamento e usa o loader normal se nao for possivel decodificar
+    #(com rate != 1, acelerando com setPlayRate, o que muda a altura)
+    def get_music(self, path, rate=1.0):
+        return self.get_music_at(path, 0.0, rate)
+
+    #AudioSound posicionado em start segundos com setTime; da memoria ele le uma
+    #fonte nova com a musica inteira (sem remove_after_read, o cursor aceita seek
+    #e o mesmo som pode ser reposicionado depois sem copiar o PCM de novo)
+    def get_music_at(self, path, start, rate=1.0):
+        key = (path, rate)
+        self.prefetch(path, rate)
+
+        with self.cond:
+            event = self.pending.get(key)
+        if event is not None:
+            event.wait(DECODE_WAIT.getValue())
+
+        with self.cond:
+            decoded = self.songs.get(key)
+            if decoded is not None:
+                self.songs.move_to_end(key)
+
+        if decoded is None:
+            music = loader.loadMusic(path)
+            music.setPlayRate(rate)
+        else:
+            music = base.musicManager.getSound(decoded.make_source())
+        music.setTime(start)
+        return music
+
+    #efeitos sonoros sao curtos e ficam sempre carregados
+    def get_sfx(self, path):
+        if path not in self.sfx:
+            self.sfx[path] = loader.loadSfx(path)
+        return self.sfx[path]
+
+    #pool de vozes do efeito, para sons que podem se sobrepor
+    def get_sfx_voices(self, path, n_voices=None):
+        if path not in self.sfx_voices:
+            self.sfx_voices[path] = SfxVoices(path, n_voices or SFX_VOICES.getValue())
+        return self.sfx_voices[path]
+
+    def play_sfx(self, path):
+        return self.get_sfx_voices(path).play()
+
+#previas decodificadas numa thread e entregues por uma task, como as miniaturas
+#(resources.ThumbnailLoader): a interface nunca espera o decoder de MP3
+class PreviewLoader:
+    def __init__(self):
+        self.previews = collections.OrderedDict()
+        self.pending = collections.deque()
+        self.done = collections.deque()
+        self.cond = threading.Condition()
+        self.callbacks = {}
+        
+        #gerenciador proprio: o musicManager do ShowBase toca um som por vez, e a
+        #previa precisa tocar junto com o tema no cross-fade
+        self.manager = AudioManager.createAudioManager()
+        base.addSfxManager(self.manager)
+        
+        self.thread = threading.Thread(target=self.run, name='preview-loader')
+        self.thread.daemon = True
+        self.thread.start()
+        
+        taskMgr.add(self.ctask_Deliver, 'preview-deliver')
+    
+    #callback(AudioSound); pedidos repetidos da mesma musica sao agrupados
+    def request(self, path, start, callback):
+        key = (path, start)
+        if key in self.previews:
+            self.previews.move_to_end(key)
+            callback(self.make_sound(self.previews[key]))
+            return
+        
+        with self.cond:
+            if key in self.callbacks:
+                self.callbacks[key].append(callback)
+                return
+            self.callbacks[key] = [callback]
+            self.pending.append(key)
+            self.cond.notify()
+    
+    #descarta pedidos ainda nao atendidos (ex.: a selecao ja mudou)
+    def cancel(self, path, start, callback):
+        with self.cond:
+            if callback in self.callbacks.get((path, start), []):
+                self.callbacks[(path, start)].remove(callback)
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                key = self.pending.popleft()
+                if not self.callbacks.get(key):
+                    del self.callbacks[key]
+                    continue
+            
+            #qualquer erro vira uma previa vazia; o resultado eh sempre entregue,
+            #para o pedido nao ficar pendente
+            decoded = None
+            try:
+                decoded = load_preview(*key)
+            except Exception as e:
+                print("Could not load preview of '%s': %s" % (key[0], e))
+            finally:
+                with self.cond:
+                    self.done.append((key, decoded))
+    
+    def make_sound(self, decoded):
+        return self.manager.getSound(decoded.make_source())
+    
+    def ctask_Deliver(self, task):
+        while self.done:
+            with self.cond:
+                key, decoded = self.done.popleft()
+                callbacks = self.callbacks.pop(key, [])
+            
+            if decoded is not None:
+                self.previews[key] = decoded
+                while len(self.previews) > PREVIEW_MEMORY:
+                    self.previews.popitem(last=False)
+                for callback in callbacks:
+                    callback(self.make_sound(decoded))
+        
+        return Task.cont
+
+audio_cache = None
+
+def get_audio_cache():
+    global audio_cache
+    if audio_cache is None:
+        audio_cache = AudioCache()
+    return audio_cache
+
+preview_loader = None
+
+def get_preview_loader():
+    global preview_loader
+    if preview_loader is None:
+        preview_loader = PreviewLoader()
+    return preview_loader
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#estima BPM e fase da primeira batida das musicas das fases e reescreve o
+#header.lvl (BPM e OFFSET) e todos os charts da fase, mantendo os instantes dos
+#aneis (as batidas sao reescaladas por bpm_novo/bpm_antigo)
+#uso, a partir da raiz do projeto:
+#   python src/bpm_tool.py [fase ...] [--levels-dir DIR] [--jobs N] [--dry-run]
+#sem fases, processa todas as fases do diretorio
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import parse
+
+#casas decimais das batidas gravadas nos charts
+BEAT_DECIMALS = 6
+
+def format_beat(beat):
+    return ("%.*f" % (BEAT_DECIMALS, beat)).rstrip('0').rstrip('.') or '0'
+
+#linhas do header com BPM e OFFSET trocados (OFFSET eh acrescentado se nao existir)
+def rescale_header(lines, bpm, offset):
+    values = {"BPM": "%.2f" % bpm, "OFFSET": "%.3f" % offset}
+
+    new_lines = []
+    for line in lines:
+        key = line.split("=")[0]
+        if key in values:
+            line = "%s=%s\n" % (key, values.pop(key))
+        elif not line.endswith("\n"):
+            line += "\n"
+        new_lines.append(line)
+
+    for key in ["BPM", "OFFSET"]:
+        if key in values:
+            new_lines.append("%s=%s\n" % (key, values[key]))
+    return new_lines
+
+#linhas do chart com as batidas multiplicadas por mult; nos charts antigos as
+#batidas relativas sao recalculadas a partir das absolutas arredondadas, para o
+#erro nao acumular
+def rescale_chart(lines, mult):
+    new_lines = []
+    absolute = bool(lines) and lines[0].strip() == parse.CHART_V2
+    old_beat = 0.0
+    new_beat = 0.0
+    for line in lines:
+        if line.startswith('!'):
+            beat_str, rest = line[1:].split(";", 1)
+            line = "!%s;%s" % (format_beat(float(parse.parse_beat(beat_str))*mult), rest)
+        elif line.strip() and not line.startswith('#'):
+            pos_str, time_str, button = line.split(";")
+            if absolute:
+                line = "%s; %s;%s" % (pos_str, format_beat(float(parse.parse_beat(time_str))*mult), button)
+            else:
+                old_beat += float(parse.parse_beat(time_str))
+                beat = round(old_beat*mult, BEAT_DECIMALS)
+                line = "%s; %s;%s" % (pos_str, format_beat(beat - new_beat), button)
+                new_beat = beat
+        new_lines.append(line)
+    return new_lines
+
+def read_lines(path):
+    f = open(path)
+    try:
+        return f.readlines()
+    finally:
+        f.close()
+
+#grava todos os arquivos em temporarios e so depois troca os originais, para
+#uma falha no meio nao deixar a fase com header e charts inconsistentes
+def write_files(files):
+    tmp_paths = []
+    try:
+        for path, lines in files:
+            tmp_path = path + '.tmp'
+            f = open(tmp_path, 'w')
+            try:
+                f.writelines(lines)
+            finally:
+                f.close()
+            tmp_paths.append((tmp_path, path))
+    except:
+        for tmp_path, path in tmp_paths:
+            os.remove(tmp_path)
+        raise
+
+    for tmp_path, path in tmp_paths:
+        os.replace(tmp_path, path)
+
+def chart_paths(level_dir, header):
+    return [os.path.join(level_dir, "%s.rng" % diff.strip()) for diff in header["DIFFICULTIES"].split(",")]
+
+#executado nos processos de trabalho
+def process_level(levels_dir, name, min_bpm, max_bpm, dry_run):
+    import analysis
+
+    parse.LEVEL_DIR = levels_dir
+    header = parse.level_header(name)
+    level_dir = os.path.join(levels_dir, name)
+    if "TEMPO" in header:
+        raise ValueError("level has tempo changes (TEMPO), it can not be retimed to a single BPM")
+
+    bpm, offset = analysis.analyze_tempo(header["MUSIC_FILE"], min_bpm, max_bpm)
+    bpm = round(bpm, 2)
+    old_bpm = header["BPM"]
+
+    if not dry_run:
+        files = [(os.path.join(level_dir, 'header.lvl'), rescale_header(read_lines(os.path.join(level_dir, 'header.lvl')), bpm, offset))]
+        for path in chart_paths(level_dir, header):
+            if os.path.exists(path):
+                files.append((path, rescale_chart(read_lines(path), bpm/old_bpm)))
+        write_files(files)
+
+    return name, old_bpm, bpm, offset
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Detect BPM and first-beat offset and retime level charts")
+    parser.add_argument('levels', nargs='*', help="level names (default: every level)")
+    parser.add_argument('--levels-dir', default=parse.LEVEL_DIR, help="levels directory (default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument('--min-bpm', type=float, default=60.0)
+    parser.add_argument('--max-bpm', type=float, default=200.0)
+    parser.add_argument('--dry-run', action='store_true', help="only print the detected values")
+    args = parser.parse_args(argv)
+
+    parse.LEVEL_DIR = args.levels_dir
+    levels = args.levels or sorted(parse.level_list())
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [(name, pool.submit(process_level, args.levels_dir, name, args.min_bpm, args.max_bpm, args.dry_run))
+                   for name in levels]
+        for name, future in futures:
+            try:
+                name, old_bpm, bpm, offset = future.result()
+                print("%s: BPM %.2f -> %.2f, first beat at %.3fs" % (name, old_bpm, bpm, offset))
+            except Exception as e:
+                failed += 1
+                print("%s: failed (%s)" % (name, e))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit(main(sys.argv[1:]))
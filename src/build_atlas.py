@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#gera o atlas de texturas do HUD (julgamentos, ranks, botoes e setas)
+#uso, a partir da raiz do projeto: python src/build_atlas.py
+
+import os
+
+from panda3d.core import PNMImage, Filename
+
+ATLAS_IMAGE = './image/hud_atlas.png'
+ATLAS_INDEX = './image/hud_atlas.txt'
+
+ATLAS_WIDTH = 1024
+PADDING = 2
+
+HUD_SPRITES = (
+    ['./image/j_%s.png' % j for j in ['perfect', 'good', 'ok', 'bad', 'miss']] +
+    ['./image/wii_%s.png' % d for d in ['down', 'right', 'left', 'up']] +
+    ['./image/b_marker.png'] +
+    ['./image/rank_%s.png' % r for r in ['ss', 's', 'a', 'b', 'c', 'f']] +
+    ['./image/arrow_left.png', './image/arrow_right.png']
+)
+
+def sprite_name(path):
+    return os.path.normpath(path).replace(os.sep, '/')
+
+def next_pow2(n):
+    p = 1
+    while p < n:
+        p *= 2
+    return p
+
+#empacotamento em prateleiras: maiores primeiro, da esquerda para a direita
+def pack(sizes, width):
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    positions = [None]*len(sizes)
+
+    x = y = shelf_h = 0
+    for i in order:
+        w, h = sizes[i]
+        if x + w > width:
+            x = 0
+            y += shelf_h + PADDING
+            shelf_h = 0
+        positions[i] = (x, y)
+        x += w + PADDING
+        shelf_h = max(shelf_h, h)
+
+    return positions, y + shelf_h
+
+def build_atlas(sprites=HUD_SPRITES, atlas_image=ATLAS_IMAGE, atlas_index=ATLAS_INDEX, width=ATLAS_WIDTH):
+    images = []
+    for path in sprites:
+        img = PNMImage()
+        if not img.read(Filename(path)):
+            raise IOError("Could not read sprite '%s'" % path)
+        if not img.hasAlpha():
+            img.addAlpha()
+            img.alphaFill(1)
+        images.append(img)
+
+    positions, used_h = pack([(img.getXSize(), img.getYSize()) for img in images], width)
+    height = next_pow2(used_h)
+
+    atlas = PNMImage(width, height, 4)
+    atlas.alphaFill(0)
+
+    #indice: nome;u0;v0;u1;v1 (v cresce para cima, como nas texturas do Panda)
+    lines = []
+    for path, img, (x, y) in zip(sprites, images, positions):
+        atlas.copySubImage(img, x, y)
+
+        w, h = img.getXSize(), img.getYSize()
+        lines.append("%s;%f;%f;%f;%f" % (sprite_name(path), float(x)/width, 1.0 - float(y + h)/height,
+                                          float(x + w)/width, 1.0 - float(y)/height))
+
+    atlas.write(Filename(atlas_image))
+
+    tmp_index = atlas_index + '.tmp'
+    f = open(tmp_index, 'w')
+    try:
+        f.write("\n".join(lines) + "\n")
+    finally:
+        f.close()
+    os.replace(tmp_index, atlas_index)
+
+    print("Atlas %dx%d with %d sprites written to %s" % (width, height, len(sprites), atlas_image))
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    build_atlas()
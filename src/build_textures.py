@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#pre-processa as texturas do jogo em arquivos .txo (ja redimensionados para
+#potencia de 2, com mipmaps e opcionalmente comprimidos), indexados pelo hash
+#do arquivo de origem. O resources.get_texture usa o .txo quando ele existe.
+#uso, a partir da raiz do projeto: python src/build_textures.py [--compress]
+
+import os
+import sys
+import glob
+import hashlib
+import argparse
+
+TEXTURE_CACHE_DIR = './cache/textures'
+
+TEXTURE_SOURCES = [
+    './image/*.png',
+    './image/*.jpg',
+    './levels/*/image.png',
+    './models/*.tga',
+    './models/*.jpg',
+]
+
+def source_hash(path):
+    f = open(path, 'rb')
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+def cached_texture_path(path):
+    return os.path.join(TEXTURE_CACHE_DIR, source_hash(path) + '.txo')
+
+def bake_texture(path, compress=False, mipmaps=True):
+    from panda3d.core import Texture, Filename, SamplerState
+
+    txo_path = cached_texture_path(path)
+    if os.path.exists(txo_path):
+        return txo_path, False
+
+    tex = Texture()
+    if not tex.read(Filename(path)):
+        raise IOError("Could not read texture '%s'" % path)
+
+    if mipmaps:
+        tex.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+        tex.generateRamMipmapImages()
+
+    if compress:
+        tex.compressRamImage(Texture.CMDefault)
+
+    tmp_path = txo_path + '.tmp.txo'
+    if not tex.write(Filename(tmp_path)):
+        raise IOError("Could not write '%s'" % txo_path)
+    os.replace(tmp_path, txo_path)
+
+    return txo_path, True
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bake game textures into cached .txo files")
+    parser.add_argument('--compress', action='store_true', help="store compressed (DXT) images")
+    parser.add_argument('--no-mipmaps', action='store_true', help="do not pre-generate mipmaps")
+    parser.add_argument('--power2', default='down', choices=['down', 'up', 'pad', 'none'],
+                        help="power-of-two policy applied before baking (default: down, as at runtime)")
+    args = parser.parse_args(argv)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('build_textures', 'textures-power-2 %s' % args.power2)
+
+    if not os.path.isdir(TEXTURE_CACHE_DIR):
+        os.makedirs(TEXTURE_CACHE_DIR)
+
+    n_baked = 0
+    sources = sorted(set(p for pattern in TEXTURE_SOURCES for p in glob.glob(pattern)))
+    for path in sources:
+        txo_path, baked = bake_texture(path, compress=args.compress, mipmaps=not args.no_mipmaps)
+        if baked:
+            n_baked += 1
+            print("%s -> %s" % (path, txo_path))
+
+    print("%d textures baked, %d already up to date" % (n_baked, len(sources) - n_baked))
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#gera charts (.rng) a partir da musica da fase: onsets por fluxo espectral,
+#quantizados na grade de batidas do BPM, TEMPO e OFFSET do header.lvl, um chart
+#por dificuldade de DIFFICULTIES
+#uso, a partir da raiz do projeto:
+#   python src/chartgen.py [fase ...] [--density Normal=1.0 ...] [--force] [--jobs N]
+#sem fases, processa todas as fases do diretorio
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import analysis
+import parse
+from bpm_tool import format_beat, write_files
+from utils import clamp, TempoMap
+
+#faixas de frequencia (Hz) e o botao de cada uma, do grave ao agudo
+BUTTON_BANDS = [
+    ((20.0, 200.0), 'A'),
+    ((200.0, 800.0), 'B'),
+    ((800.0, 3000.0), 'C'),
+    ((3000.0, 11000.0), 'D'),
+]
+
+#(aneis por batida, subdivisoes da grade por batida) de cada dificuldade
+DENSITIES = {
+    'Easy': (0.5, 1),
+    'Normal': (1.0, 2),
+    'Hard': (2.0, 4),
+}
+DEFAULT_DENSITY = DENSITIES['Normal']
+
+#area de voo em coordenadas de chart (multiplicadas por FLY_AREA_W/H no jogo)
+POS_X = (-0.25, 0.25)
+POS_Y = (-0.33, 0.2)
+#deslocamento maximo entre aneis, por batida, para o caminho ser alcancavel
+MAX_MOVE_PER_BEAT = 0.15
+
+#onsets: maximos locais do envelope acima de media + threshold*desvio padrao
+def pick_onsets(env, window=3, threshold=0.5):
+    padded = np.pad(env, window, mode='constant')
+    neighbours = np.lib.stride_tricks.sliding_window_view(padded, 2*window + 1)
+    is_peak = (env >= neighbours.max(axis=1)) & (env > env.mean() + threshold*env.std())
+    return np.nonzero(is_peak)[0]
+
+#um onset por posicao da grade (o mais forte), depois os mais fortes ate a
+#densidade pedida; onset_beats sao contados desde o OFFSET. Devolve, em ordem,
+#os indices de grade, as forcas e os quadros de origem
+def quantize(onset_beats, strengths, frames, subdiv, n_beats, density):
+    slots = np.round(onset_beats*subdiv).astype(int)
+    valid = slots >= 0
+    slots, strengths, frames = slots[valid], strengths[valid], frames[valid]
+
+    order = np.lexsort((-strengths, slots))
+    slots, strengths, frames = slots[order], strengths[order], frames[order]
+    first = np.ones(len(slots), dtype=bool)
+    first[1:] = slots[1:] != slots[:-1]
+    slots, strengths, frames = slots[first], strengths[first], frames[first]
+
+    max_rings = int(density*n_beats)
+    if len(slots) > max_rings:
+        keep = np.sort(np.argsort(-strengths)[:max_rings])
+        slots, strengths, frames = slots[keep], strengths[keep], frames[keep]
+    return slots, strengths, frames
+
+#x pela frequencia (centroide das faixas), y pela forca do onset, limitados
+#ao deslocamento alcancavel desde o anel anterior
+def ring_positions(band_flux, strengths, beats):
+    centers = np.arange(band_flux.shape[1])
+    weights = band_flux.sum(axis=1)
+    centroid = np.where(weights > 0, (band_flux*centers).sum(axis=1)/np.maximum(weights, 1e-9), (len(centers) - 1)/2.0)
+    xs = POS_X[0] + (POS_X[1] - POS_X[0])*centroid/max(len(centers) - 1, 1)
+
+    top = strengths.max() if len(strengths) else 1.0
+    ys = POS_Y[0] + (POS_Y[1] - POS_Y[0])*strengths/max(top, 1e-9)
+
+    positions = []
+    last_x, last_y, last_beat = 0.0, 0.0, 0.0
+    for x, y, beat in zip(xs, ys, beats):
+        move = MAX_MOVE_PER_BEAT*max(beat - last_beat, 0.25)
+        last_x = clamp(last_x - move, float(x), last_x + move)
+        last_y = clamp(last_y - move, float(y), last_y + move)
+        last_beat = beat
+        positions.append((round(last_x, 2), round(last_y, 2)))
+    return positions
+
+#formato v2: batidas absolutas
+def chart_lines(beats, positions, buttons, name, difficulty):
+    lines = [parse.CHART_V2 + "\n", "#chart %s gerado por chartgen.py para '%s'\n" % (difficulty, name), "\n"]
+    for beat, (x, y), button in zip(beats, positions, buttons):
+        lines.append("%s, %s; %s; %s\n" % (format_beat(x), format_beat(y), format_beat(beat), button))
+    return lines
+
+#executado nos processos de trabalho
+def process_level(levels_dir, name, densities, force):
+    parse.LEVEL_DIR = levels_dir
+    header = parse.level_header(name)
+    level_dir = os.path.join(levels_dir, name)
+
+    samples, rate = analysis.load_mono(header["MUSIC_FILE"])
+    band_flux = analysis.spectral_flux(samples, rate, bands=[band for band, button in BUTTON_BANDS])
+    #normaliza cada faixa pela media, para os agudos nao perderem sempre para os graves
+    band_flux = band_flux/np.maximum(band_flux.mean(axis=0), 1e-9)
+    env = band_flux.sum(axis=1)
+
+    #a grade segue as mudancas de andamento, como os aneis no jogo
+    tempo = TempoMap(header["BPM"], header.get("TEMPO", []))
+    if "OFFSET" in header:
+        offset = header["OFFSET"]
+    else:
+        offset = analysis.estimate_offset(env, rate, header["BPM"])
+    offset_beat = tempo.time2beat(offset)
+
+    frames = pick_onsets(env)
+    onset_times = analysis.frame_times(len(env), rate)[frames]
+    onset_beats = np.array([tempo.time2beat(t) for t in onset_times]) - offset_beat
+    n_beats = tempo.time2beat(len(samples)/float(rate)) - offset_beat
+
+    files = []
+    charts = []
+    for difficulty in [d.strip() for d in header["DIFFICULTIES"].split(",")]:
+        path = os.path.join(level_dir, "%s.rng" % difficulty)
+        if os.path.exists(path) and not force:
+            continue
+
+        density, subdiv = densities.get(difficulty, DEFAULT_DENSITY)
+        slots, strengths, slot_frames = quantize(onset_beats, env[frames], frames, subdiv, n_beats, density)
+        if not len(slots):
+            raise ValueError("no onsets found for %s" % difficulty)
+
+        #o jogo conta as batidas desde o inicio da musica, entao a fase entra nas batidas
+        beats = [offset_beat + float(s)/subdiv for s in slots]
+        buttons = [BUTTON_BANDS[b][1] for b in band_flux[slot_frames].argmax(axis=1)]
+        positions = ring_positions(band_flux[slot_frames], strengths, beats)
+
+        files.append((path, chart_lines(beats, positions, buttons, name, difficulty)))
+        charts.append((os.path.basename(path), len(beats)))
+
+    write_files(files)
+    return name, charts
+
+def parse_density(value):
+    try:
+        difficulty, density = value.split("=")
+        return difficulty, float(density)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected DIFFICULTY=RINGS_PER_BEAT, got '%s'" % value)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Generate level charts from onsets in the song")
+    parser.add_argument('levels', nargs='*', help="level names (default: every level)")
+    parser.add_argument('--levels-dir', default=parse.LEVEL_DIR, help="levels directory (default: %(default)s)")
+    parser.add_argument('--density', type=parse_density, action='append', default=[],
+                        help="rings per beat for a difficulty, e.g. Hard=2.5 (repeatable)")
+    parser.add_argument('--force', action='store_true', help="overwrite existing charts")
+    parser.add_argument('--jobs', type=int, default=None, help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    densities = dict(DENSITIES)
+    for difficulty, density in args.density:
+        subdiv = densities.get(difficulty, DEFAULT_DENSITY)[1]
+        #a grade precisa ser pelo menos tao fina quanto a densidade
+        while subdiv < density:
+            subdiv *= 2
+        densities[difficulty] = (density, subdiv)
+
+    parse.LEVEL_DIR = args.levels_dir
+    levels = args.levels or sorted(parse.level_list())
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [(name, pool.submit(process_level, args.levels_dir, name, densities, args.force)) for name in levels]
+        for name, future in futures:
+            try:
+                name, charts = future.result()
+                if charts:
+                    print("%s: %s" % (name, ", ".join(["%s (%d rings)" % c for c in charts])))
+                else:
+                    print("%s: charts already exist (use --force to overwrite)" % name)
+            except Exception as e:
+                failed += 1
+                print("%s: failed (%s)" % (name, e))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit(main(sys.argv[1:]))
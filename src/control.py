@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import ast
+import collections
 
 if __name__=='__main__':
     import direct.directbase.DirectStart
@@ -14,6 +16,8 @@ from direct.showbase import DirectObject
 import pygame
 from pygame.locals import *
 
+import options
+
 NAV_CMDS = ['nav-up', 'nav-down', 'nav-left', 'nav-right', 'nav-confirm', 'nav-back']
 DEFAULT_NAV_KEY_MAP = {
     'arrow_up':0,
@@ -33,41 +37,270 @@ DEFAULT_NAV_JOY_MAP = {
     ('b', 1)    :5,
 }
 
+
+#eventos de jogo que levam o instante do aperto como ultimo argumento
+BUTTON_EVENTS = ['key-button', 'joy-button', 'wii-button', 'nunchuk-button']
+
+#mapeamentos fixos do Wiimote e do Nunchuk (direcional/analogico -> botao do jogo)
+DEFAULT_DISPATCH = {
+    ('key', 's'): ('key-button', ['A']),
+    ('key', 'd'): ('key-button', ['B']),
+    ('key', 'a'): ('key-button', ['C']),
+    ('key', 'w'): ('key-button', ['D']),
     
-#classe para tratamento de joystick
-class JoyNavMapper:
-    def __init__(self, joystick, map=DEFAULT_NAV_JOY_MAP):
-        self.map = map
-        self.joy = joystick
+    ('wii', 'down'): ('wii-button', ['A']),
+    ('wii', 'right'): ('wii-button', ['B']),
+    ('wii', 'left'): ('wii-button', ['C']),
+    ('wii', 'up'): ('wii-button', ['D']),
+    ('wii', 'home'): ('wii-out', []),
+    
+    ('nunchuk', 'down'): ('nunchuk-button', ['A']),
+    ('nunchuk', 'right'): ('nunchuk-button', ['B']),
+    ('nunchuk', 'left'): ('nunchuk-button', ['C']),
+    ('nunchuk', 'up'): ('nunchuk-button', ['D']),
+}
+
+InputEvent = collections.namedtuple('InputEvent', ['device', 'control', 'pressed', 'time'])
+
+def _map_items(opts, section):
+    if opts is not None and opts.has_section(section):
+        return opts.items(section)
+    return options.DEFAULTS[section].items()
+
+def _control_key(k):
+    if isinstance(k, str) and k.startswith('('):
+        return ast.literal_eval(k)
+    return k
+
+#monta a tabela (dispositivo, controle) -> (evento, argumentos) a partir do options.cfg
+def compile_dispatch(opts=None):
+    table = dict(DEFAULT_DISPATCH)
+    
+    for k, v in _map_items(opts, 'key-nav-map'):
+        table[('key', _control_key(k))] = (NAV_CMDS[int(v)], [])
+    
+    for k, v in _map_items(opts, 'joy-nav-map'):
+        table[('joy-nav', _control_key(k))] = (NAV_CMDS[int(v)], [])
+    
+    #eixos analogicos (aX, aY) sao lidos diretamente, nao geram eventos
+    for k, v in _map_items(opts, 'joy-map'):
+        control = _control_key(k)
+        if control[0] == 'b':
+            table[('joy', control)] = ('joy-button', [options.ACT_CMDS[int(v)]])
+    
+    return table
+
+#fila de eventos de entrada: os dispositivos geram apenas bordas (aperto/soltura)
+#com o instante em que foram vistas, e a fila eh despachada uma vez por frame
+class InputQueue:
+    def __init__(self, table=None):
+        if table is None:
+            table = compile_dispatch()
+        self.table = table
+        self.events = collections.deque()
+        self.states = {}
+        
+    def set_table(self, table):
+        self.table = table
+    
+    def push(self, device, control, pressed, time=None):
+        if time is None:
+            time = globalClock.getRealTime()
+        self.events.append(InputEvent(device, control, pressed, time))
+    
+    #compara os controles pressionados agora com os da ultima leitura e enfileira as bordas
+    def update(self, device, pressed):
+        last = self.states.get(device, frozenset())
+        now = frozenset(pressed)
+        if now == last:
+            return
         
-        self.valid_buttons = [t[1] for t in map.keys() if t[0]=='b']
-        self.valid_axes = [t[1] for t in map.keys() if t[0]=='a']
+        time = globalClock.getRealTime()
+        for control in now - last:
+            self.push(device, control, True, time)
+        for control in last - now:
+            self.push(device, control, False, time)
+        self.states[device] = now
+    
+    def reset(self, device):
+        self.states.pop(device, None)
+        
+    def activate(self):
+        #roda depois das tarefas que leem os dispositivos
+        taskMgr.add(self.ctask_Dispatch, 'input-dispatch', sort=10)
         
-        self.buttons_pressed = {}
-        for b in self.valid_buttons:
-            self.buttons_pressed[b] = False
+    def deactivate(self):
+        taskMgr.remove('input-dispatch')
+    
+    def ctask_Dispatch(self, task):
+        while self.events:
+            evt = self.events.popleft()
+            if not evt.pressed:
+                continue
+            
+            target = self.table.get((evt.device, evt.control))
+            if target:
+                event, args = target
+                if event in BUTTON_EVENTS:
+                    messenger.send(event, args + [evt.time])
+                else:
+                    messenger.send(event, args)
         
-        self.axis_pressed = {}
-        for a in self.valid_axes:
-            self.axis_pressed[(a, 1)] = False
-            self.axis_pressed[(a, -1)] = False
+        return Task.cont
+
+input_queue = None
+
+def get_input_queue():
+    global input_queue
+    if input_queue is None:
+        input_queue = InputQueue()
+        input_queue.activate()
+    return input_queue
+    
+#servico unico de joystick: inicializa so o necessario do pygame, faz o pump
+#uma vez por frame e guarda o estado lido para o menu e para o jogo
+class JoystickService:
+    def __init__(self):
+        #o pump de eventos do pygame exige o modulo de display, mas nenhuma janela eh aberta
+        pygame.display.init()
+        pygame.joystick.init()
+        
+        self.joysticks = {}
+        self.buttons = {}
+        self.axes = {}
+        
+        taskMgr.add(self.ctask_Pump, 'joystick-pump', sort=-10)
+    
+    def get_count(self):
+        return pygame.joystick.get_count()
+    
+    def open(self, id):
+        if id not in self.joysticks:
+            joy = pygame.joystick.Joystick(id)
+            joy.init()
+            self.joysticks[id] = joy
+            self.read(id)
+        return self.joysticks[id]
+    
+    def read(self, id):
+        joy = self.joysticks[id]
+        self.buttons[id] = tuple(joy.get_button(i) for i in range(joy.get_numbuttons()))
+        self.axes[id] = tuple(joy.get_axis(i) for i in range(joy.get_numaxes()))
+    
+    def get_button(self, id, button):
+        buttons = self.buttons[id]
+        return button < len(buttons) and buttons[button]
+    
+    def get_axis(self, id, axis):
+        axes = self.axes[id]
+        if axis < len(axes):
+            return axes[axis]
+        return .0
+    
+    def ctask_Pump(self, task):
+        pygame.event.pump()
+        for id in self.joysticks:
+            self.read(id)
+        return Task.cont
+
+joystick_service = None
+
+def get_joystick_service():
+    global joystick_service
+    if joystick_service is None:
+        joystick_service = JoystickService()
+    return joystick_service
+
+#classe para tratamento de joystick no menu: repassa botoes e direcionais para a fila de entrada
+class JoyNavMapper:
+    AXIS_THRESHOLD = 0.5
+    
+    def __init__(self, joy_id=0, queue=None):
+        self.joy_id = joy_id
+        self.service = get_joystick_service()
+        self.service.open(joy_id)
+        
+        self.queue = queue or get_input_queue()
+        self.controls = [c for (device, c) in self.queue.table.keys() if device == 'joy-nav']
         
     def activate(self):
         taskMgr.add(self.ctask_CheckEvents, 'check-joy-events')
         
     def deactivate(self):
-        taskMgr.remove(self.ctask_CheckEvents)
+        taskMgr.remove('check-joy-events')
+        self.queue.reset('joy-nav')
+        
+    def is_pressed(self, control):
+        if control[0] == 'b':
+            return self.service.get_button(self.joy_id, control[1])
+        return self.service.get_axis(self.joy_id, control[1])*control[2] > self.AXIS_THRESHOLD
         
     def ctask_CheckEvents(self, task):
+        self.queue.update('joy-nav', [c for c in self.controls if self.is_pressed(c)])
         return Task.cont
     
-#classe para tratamento de Keyboard
+#mouse em modo relativo: acumula os deslocamentos dos mouses fisicos (read-raw-mice)
+#sem mover o ponteiro, independente do tamanho da janela
+class RelativeMouse:
+    def __init__(self, win, sensitivity):
+        self.win = win
+        self.sensitivity = sensitivity
+        #modo do mouse da janela antes da fase, devolvido em release
+        self.mouse_mode = win.getProperties().getMouseMode()
+        
+        #com read-raw-mice os ponteiros 1..n sao os mouses fisicos, com coordenadas sem limite
+        self.devices = list(range(1, win.getNumInputDevices()))
+        self.relative = not self.devices
+        if self.relative:
+            self.devices = [0]
+        
+        self.capture()
+    
+    #prende o ponteiro (sem read-raw-mice) e descarta o deslocamento acumulado
+    def capture(self):
+        if self.relative:
+            self.set_mode(WindowProperties.M_relative)
+        
+        self.last = {}
+        for d in self.devices:
+            self.last[d] = self.read(d)
+    
+    def release(self):
+        if self.relative:
+            self.set_mode(self.mouse_mode)
+    
+    def set_mode(self, mode):
+        props = WindowProperties()
+        props.setMouseMode(mode)
+        self.win.requestProperties(props)
+    
+    def read(self, device):
+        pointer = self.win.getPointer(device)
+        return pointer.getX(), pointer.getY()
+    
+    #deslocamento desde a ultima leitura, ja multiplicado pela sensibilidade
+    def get_delta(self):
+        dx = dy = 0
+        for d in self.devices:
+            x, y = self.read(d)
+            last_x, last_y = self.last[d]
+            dx += x - last_x
+            dy += y - last_y
+            self.last[d] = (x, y)
+        
+        return dx*self.sensitivity, dy*self.sensitivity
+
+#classe para tratamento de Keyboard: repassa as teclas da tabela para a fila de entrada
 class KeyNavMapper(DirectObject.DirectObject):
-    def __init__(self, map=DEFAULT_NAV_KEY_MAP):
+    def __init__(self, queue=None):
         DirectObject.DirectObject.__init__(self)
         
-        for k, v in map.items():
-            self.accept(k, messenger.send, [NAV_CMDS[v]])
+        self.queue = queue or get_input_queue()
+        
+        for device, key in self.queue.table.keys():
+            if device == 'key':
+                self.accept(key, self.queue.push, ['key', key, True])
+                self.accept(key + '-up', self.queue.push, ['key', key, False])
 
 if __name__=='__main__':
     class EvtPrinter(DirectObject.DirectObject):
@@ -9,6 +9,7 @@ This allows the original MoonBunny cwiid code to work with the modern wiiuse lib
 import wiiuse
 import time
 import threading
+import collections
 
 # cwiid constants mapped to wiiuse equivalents
 LED1_ON = wiiuse.LED_1
@@ -40,6 +41,18 @@ EXT_NONE = 0
 EXT_NUNCHUK = 1
 EXT_CLASSIC = 2
 
+# Extension event constants
+EXT_ATTACHED = 'attached'
+EXT_DETACHED = 'detached'
+
+# wiiuse expansion types mapped to cwiid extension constants
+_EXP_TO_EXT = {wiiuse.EXP_NUNCHUK: EXT_NUNCHUK}
+if hasattr(wiiuse, 'EXP_CLASSIC'):
+    _EXP_TO_EXT[wiiuse.EXP_CLASSIC] = EXT_CLASSIC
+
+# Minimum interval between output reports (rumble/LEDs), in seconds
+OUTPUT_REPORT_INTERVAL = 0.02
+
 # Axis constants for accelerometer
 X = 0
 Y = 1
@@ -51,12 +64,22 @@ class WiimoteState:
         self.buttons = 0
         self.acc = [0, 0, 0]
         self.ir_src = []
+        self.ext_type = EXT_NONE
         self.nunchuk = {
             'stick': [128, 128],
             'acc': [0, 0, 0],
             'buttons': 0
         }
 
+    def __getitem__(self, key):
+        """Dict-style access, like cwiid: 'nunchuk' is only present while attached"""
+        if key == 'nunchuk' and self.ext_type != EXT_NUNCHUK:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
 class Wiimote:
     """Compatibility wrapper for wiiuse that mimics cwiid.Wiimote"""
     
@@ -66,11 +89,23 @@ class Wiimote:
         self.wiimotes = None
         self.wiimote = None
         self.state = WiimoteState()
-        self.led = 0
         self.rpt_mode = RPT_BTN
         self._running = False
         self._thread = None
         
+        # Output state: requested values are flushed by the polling thread
+        self._led = LED1_ON
+        self._rumble = 0
+        self._rumble_until = 0.0
+        self._sent_led = LED1_ON
+        self._sent_rumble = 0
+        self._last_output = 0.0
+        
+        # Extension state: None until the first expansion status arrives
+        self._ext_type = None
+        self._ext_cond = threading.Condition()
+        self._ext_events = collections.deque()
+        
         # Initialize wiiuse
         self.wiimotes = wiiuse.init(1)  # Support 1 wiimote
         if not self.wiimotes:
@@ -92,6 +127,10 @@ class Wiimote:
         wiiuse.set_flags(self.wiimote, wiiuse.INIT_FLAGS, 0)
         wiiuse.motion_sensing(self.wiimote, 1)
         
+        # Ask for a status report so the expansion handshake is reported early
+        if hasattr(wiiuse, 'status'):
+            wiiuse.status(self.wiimote)
+        
         # Start polling thread
         self._running = True
         self._thread = threading.Thread(target=self._poll_loop)
@@ -103,8 +142,50 @@ class Wiimote:
         while self._running:
             if wiiuse.poll(self.wiimotes, 1):
                 self._update_state()
+            self._flush_output()
             time.sleep(0.01)  # 100Hz polling
     
+    def _flush_output(self):
+        """Send rumble/LED transitions, at most one report per OUTPUT_REPORT_INTERVAL"""
+        now = time.time()
+        if now - self._last_output < OUTPUT_REPORT_INTERVAL:
+            return
+        
+        rumble = 1 if (self._rumble or now < self._rumble_until) else 0
+        if rumble != self._sent_rumble:
+            wiiuse.rumble(self.wiimote, rumble)
+            self._sent_rumble = rumble
+            self._last_output = now
+        
+        led = self._led
+        if led != self._sent_led:
+            wiiuse.set_leds(self.wiimote, led)
+            self._sent_led = led
+            self._last_output = now
+    
+    @property
+    def rumble(self):
+        return self._rumble
+    
+    @rumble.setter
+    def rumble(self, value):
+        """Request continuous rumble on/off; turning it off also cancels a pulse"""
+        self._rumble = 1 if value else 0
+        if not value:
+            self._rumble_until = 0.0
+    
+    @property
+    def led(self):
+        return self._led
+    
+    @led.setter
+    def led(self, value):
+        self._led = value
+    
+    def rumble_pulse(self, duration):
+        """Rumble for duration seconds; overlapping pulses extend each other"""
+        self._rumble_until = max(self._rumble_until, time.time() + duration)
+    
     def _update_state(self):
         """Update the state object with current wiimote data"""
         if not self.wiimote:
@@ -141,6 +222,10 @@ class Wiimote:
             self.state.acc[Y] = self.wiimote.contents.accel.y
             self.state.acc[Z] = self.wiimote.contents.accel.z
         
+        # Track extension attach/detach from the expansion status
+        if hasattr(self.wiimote.contents, 'exp'):
+            self._set_extension(_EXP_TO_EXT.get(self.wiimote.contents.exp.type, EXT_NONE))
+        
         # Update nunchuk data if connected
         if hasattr(self.wiimote.contents, 'exp') and self.wiimote.contents.exp.type == wiiuse.EXP_NUNCHUK:
             nunchuk = self.wiimote.contents.exp.nunchuk
@@ -157,6 +242,40 @@ class Wiimote:
             if wiiuse.is_pressed(self.wiimote, wiiuse.nunchuk_button.Z):
                 self.state.nunchuk['buttons'] |= 0x01
     
+    def _set_extension(self, ext_type):
+        """Record the current extension and queue an event when it changes"""
+        with self._ext_cond:
+            if ext_type == self._ext_type:
+                return
+            
+            old_type = self._ext_type
+            self._ext_type = ext_type
+            self.state.ext_type = ext_type
+            
+            # The first report is the initial state, not a hot-plug
+            if old_type is not None:
+                if old_type != EXT_NONE:
+                    self._ext_events.append((EXT_DETACHED, old_type))
+                if ext_type != EXT_NONE:
+                    self._ext_events.append((EXT_ATTACHED, ext_type))
+            
+            self._ext_cond.notify_all()
+    
+    def wait_extension(self, timeout=0.5):
+        """Return the attached extension, waiting at most timeout seconds for the first status report"""
+        with self._ext_cond:
+            self._ext_cond.wait_for(lambda: self._ext_type is not None, timeout)
+            if self._ext_type is None:
+                return EXT_NONE
+            return self._ext_type
+    
+    def get_ext_events(self):
+        """Drain pending (EXT_ATTACHED|EXT_DETACHED, ext_type) events"""
+        with self._ext_cond:
+            events = list(self._ext_events)
+            self._ext_events.clear()
+        return events
+    
     def get_acc_cal(self, ext_type):
         """Get accelerometer calibration data"""
         # Return default calibration values
@@ -168,6 +287,8 @@ class Wiimote:
         self._running = False
         if self._thread:
             self._thread.join()
+        if self.wiimote and self._sent_rumble:
+            wiiuse.rumble(self.wiimote, 0)
         if self.wiimotes:
             wiiuse.disconnect(self.wiimotes[0])
     
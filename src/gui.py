@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import heapq
+
 from direct.task import Task
 from direct.gui.OnscreenText import OnscreenText
 from direct.gui.OnscreenImage import OnscreenImage
@@ -8,9 +10,11 @@ from direct.gui.OnscreenImage import OnscreenImage
 from panda3d.core import *
 from direct.interval.IntervalGlobal import *
 
+import resources
 from utils import *
 
 babelfish_font = None
+digit_glyphs = {}
 
 def get_babelfish_font():
     global babelfish_font
@@ -18,6 +22,87 @@ def get_babelfish_font():
         babelfish_font = loader.loadFont('./fonts/hum.egg')
     return babelfish_font
 
+#texto que mantem sempre o mesmo no; a geometria so eh refeita quando o texto muda
+class DynamicText:
+    def __init__(self, text_node, parent):
+        self.text_node = text_node
+        self.np = parent.attachNewNode(text_node)
+        self.text = None
+        
+    def set_text(self, text):
+        if text != self.text:
+            self.text = text
+            self.text_node.setText(text)
+        if self.np.isStashed():
+            self.np.unstash()
+            
+    def clear(self):
+        self.np.stash()
+        
+    def destroy(self):
+        self.np.removeNode()
+
+#geometria dos digitos 0-9 gerada uma unica vez por estilo de texto (nome do TextNode)
+def get_digit_glyphs(template):
+    key = template.getName()
+    if key not in digit_glyphs:
+        text_node = TextNode(key + '-glyphs', template)
+        text_node.setAlign(TextNode.ACenter)
+        
+        root = NodePath(key + '-glyphs')
+        glyphs = []
+        for d in range(10):
+            text_node.setText(str(d))
+            glyphs.append(root.attachNewNode(text_node.generate()))
+        
+        width = max([text_node.calcWidth(str(d)) for d in range(10)])
+        digit_glyphs[key] = (glyphs, width)
+    return digit_glyphs[key]
+
+#contador de largura fixa: cada casa tem uma instancia de cada digito e so troca
+#qual esta visivel, sem gerar texto novo
+class NumericCounter:
+    def __init__(self, template, digits, parent, pad='0'):
+        glyphs, self.cell_width = get_digit_glyphs(template)
+        
+        self.node = parent.attachNewNode(template.getName() + '-counter')
+        self.slots = []
+        for i in range(digits):
+            slot = self.node.attachNewNode('digit%d' % i)
+            slot.setX((i + 0.5)*self.cell_width)
+            instances = [glyph.instanceTo(slot) for glyph in glyphs]
+            for instance in instances:
+                instance.stash()
+            self.slots.append(instances)
+        
+        self.pad = pad
+        self.max_value = 10**digits - 1
+        self.shown = [None]*digits
+        self.value = None
+        self.set_value(0)
+        
+    def get_width(self):
+        return self.cell_width*len(self.slots)
+    
+    def set_value(self, value):
+        value = min(max(int(value), 0), self.max_value)
+        if value == self.value:
+            return
+        self.value = value
+        
+        digits = str(value).rjust(len(self.slots), self.pad)
+        for i, c in enumerate(digits):
+            d = int(c) if c.isdigit() else None
+            if d != self.shown[i]:
+                if self.shown[i] is not None:
+                    self.slots[i][self.shown[i]].stash()
+                if d is not None:
+                    self.slots[i][d].unstash()
+                self.shown[i] = d
+    
+    def destroy(self):
+        self.node.removeNode()
+
 class TitleMessage:
     def __init__(self, title, artist):
         text_node = TextNode('title_display')
@@ -65,26 +150,25 @@ class TitleMessage:
         
 
 class ButtonViewer:
-    def __init__(self, bpm, z_pos = -0.7):
+    def __init__(self, tempo, z_pos = -0.7):
         self.BTN_SPACE_PER_BEAT = 0.2
         self.BTN_SIZE = 64.0
         self.BTN_SIZE = 64.0
         self.BTN_SCALE = (self.BTN_SIZE/base.win.getXSize(), 1 ,self.BTN_SIZE/base.win.getYSize())
         
         self.z_pos = z_pos
-        self.delay_per_beat = beat_delay(bpm)
+        self.tempo = tempo
         
         self.tex_buttons = {}
         for b, i in zip(["A", "B", "C", "D"],["down", "right", "left", "up"]):
-            self.tex_buttons[b] = loader.loadTexture("image/wii_%s.png" % i)
+            self.tex_buttons[b] = "image/wii_%s.png" % i
     
         #~ else:
             #~ for b, i in zip(["A", "B", "C", "D"],["cross", "circle", "square", "triangle"]):
                 #~ self.tex_buttons[b] = loader.loadTexture("image/b_%s.png" % i)
         
         ## Button marker
-        self.button_marker = OnscreenImage(image="image/b_marker.png",pos=(0, 2, self.z_pos), scale=self.BTN_SCALE, parent=render2d)
-        self.button_marker.setTransparency(TransparencyAttrib.MAlpha)
+        self.button_marker = resources.make_sprite("image/b_marker.png",pos=(0, 2, self.z_pos), scale=self.BTN_SCALE, parent=render2d)
         
         self.button_node = render2d.attachNewNode("Button Root Node")
         self.initial_x = self.button_node.getX()
@@ -92,12 +176,11 @@ class ButtonViewer:
         self.next_button = 0
         
     def append_button(self, button, beat):
-        btn_image = OnscreenImage(image=self.tex_buttons[button], pos=(-beat*self.BTN_SPACE_PER_BEAT, 0, self.z_pos), scale=self.BTN_SCALE, parent=render2d)
-        btn_image.setTransparency(TransparencyAttrib.MAlpha)        
+        btn_image = resources.make_sprite(self.tex_buttons[button], pos=(-float(beat)*self.BTN_SPACE_PER_BEAT, 0, self.z_pos), scale=self.BTN_SCALE, parent=render2d)
         btn_image.reparentTo(self.button_node)
     
     def update(self, time):
-        self.button_node.setX(self.initial_x + time2pos(time, self.delay_per_beat, self.BTN_SPACE_PER_BEAT))
+        self.button_node.setX(self.initial_x + self.tempo.time2pos(time, self.BTN_SPACE_PER_BEAT))
         
     def button_hit(self):
         pass
@@ -116,6 +199,14 @@ class ButtonViewer:
     def button_miss(self):
         pass
         #self.next_button += 1
+    
+    def show(self):
+        self.button_node.show()
+        self.button_marker.show()
+    
+    def hide(self):
+        self.button_node.hide()
+        self.button_marker.hide()
         
     def __del__(self):
         self.button_node.removeNode()
@@ -124,8 +215,7 @@ class ButtonViewer:
 class LifeBar:
     def __init__(self):
         ## Life bar
-        self.image = OnscreenImage(image="image/life_bar.png",pos=(0, 0, 0), scale=(256.0/base.win.getXSize(),1,32.0/base.win.getYSize()), parent=render2d)
-        self.image.setTransparency(TransparencyAttrib.MAlpha)
+        self.image = resources.make_image("image/life_bar.png",pos=(0, 0, 0), scale=(256.0/base.win.getXSize(),1,32.0/base.win.getYSize()), parent=render2d)
         self.image.setZ(-0.9)
         self.image.setY(2)
         
@@ -136,75 +226,163 @@ class ScoreDisplay:
     def __init__(self):
         ## Score display
         text_node = TextNode('score_display')
-        text_node.setAlign(TextNode.ACenter)
+        text_node.setAlign(TextNode.ALeft)
         text_node.setFont(get_babelfish_font())
         text_node.setShadow(0.05, 0.05)
         text_node.setShadowColor(.0,.0,.0,.1)
         
-        self.score_display = aspect2d.attachNewNode(text_node)
+        self.score_display = aspect2d.attachNewNode('score_display')
         self.score_display.setZ(0.9)
         self.score_display.setScale(0.11)
-    
-        self.score_display.node().setText("SCORE 0000000")
+        
+        #rotulo fixo + contador de 7 casas, centralizados juntos
+        self.label = DynamicText(text_node, self.score_display)
+        self.label.set_text("SCORE ")
+        self.counter = NumericCounter(text_node, 7, self.score_display)
+        
+        label_width = text_node.calcWidth("SCORE ")
+        x = -(label_width + self.counter.get_width())/2
+        self.label.np.setX(x)
+        self.counter.node.setX(x + label_width)
         
     def update(self, score):
-        self.score_display.node().setText("SCORE %s" % str(score).rjust(7, '0'))
+        self.counter.set_value(score)
+    
+    def show(self):
+        self.score_display.show()
+    
+    def hide(self):
+        self.score_display.hide()
 
     def __del__(self):
         self.score_display.removeNode()
 
+#temporizador unico do HUD: um heap de expiracoes indexadas por chave;
+#agendar de novo a mesma chave substitui a expiracao anterior
+class HudTimer:
+    def __init__(self, name='hud-timer'):
+        self.name = name
+        self.heap = []
+        self.entries = {}
+        self.counter = 0
+        taskMgr.add(self.ctask_Expire, self.name)
+        
+    def schedule(self, key, delay, callback):
+        self.counter += 1
+        entry = (globalClock.getFrameTime() + delay, self.counter, key, callback)
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        
+    def cancel(self, key):
+        self.entries.pop(key, None)
+        
+    def ctask_Expire(self, task):
+        now = globalClock.getFrameTime()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            #entradas substituidas ou canceladas sao so descartadas
+            if self.entries.get(entry[2]) is entry:
+                del self.entries[entry[2]]
+                entry[3]()
+        return Task.cont
+        
+    def destroy(self):
+        taskMgr.remove(self.name)
+        self.heap = []
+        self.entries = {}
+
+#popup de julgamento; os intervalos sao criados uma vez e reiniciados a cada uso
+class JudgementPopup:
+    def __init__(self, tex_path):
+        self.image = resources.make_sprite(tex_path, pos=(0, 0, 0), scale=(256.0/base.win.getXSize(),1,32.0/base.win.getYSize()), parent=render2d)
+        self.image.setAlphaScale(0)
+        
+        interval_pos = LerpPosInterval(self.image, duration=0.1, startPos=VBase3(-1.2, 1, 0.5), pos=VBase3(-0.7, 1, 0.5), blendType='easeOut')
+        interval_alpha = LerpFunc(self.image.setAlphaScale, duration=0.1, blendType='easeOut')
+        interval_fade = LerpFunc(self.image.setAlphaScale, fromData=1, toData=0, duration=1.0, blendType='easeOut')
+        
+        self.enters = Sequence(Parallel(interval_pos, interval_alpha), Wait(1.0), interval_fade)
+        
+        #saida rapida (sobe e some) quando um julgamento mais novo toma o lugar
+        self.retires = Parallel(LerpPosInterval(self.image, duration=0.2, pos=VBase3(-0.7, 1, 0.6), blendType='easeOut'),
+                                LerpColorScaleInterval(self.image, duration=0.2, colorScale=(1, 1, 1, 0), blendType='easeOut'))
+        
+    def show(self, tex_path):
+        self.retires.pause()
+        resources.set_sprite(self.image, tex_path)
+        self.enters.start()
+        
+    def retire(self):
+        if self.enters.isPlaying():
+            self.enters.pause()
+            self.retires.start()
+            
+    def destroy(self):
+        self.enters.finish()
+        self.retires.finish()
+        self.image.destroy()
+
 class ScreenDecorationManager:
+    POPUP_POOL_SIZE = 3
+    CHAIN_TIMEOUT = 1.5
+    
     def __init__(self):
         self.tex_judgements = {}
         
         for i in ["PERFECT","GOOD","OK","BAD","MISS"]:
-            self.tex_judgements[i] = loader.loadTexture("image/j_%s.png" % i.lower())
+            self.tex_judgements[i] = "image/j_%s.png" % i.lower()
         
         ## Judgement message
-        self.image_judgement = OnscreenImage(image=self.tex_judgements["OK"],pos=(0, 0, 0), scale=(256.0/base.win.getXSize(),1,32.0/base.win.getYSize()), parent=render2d)
-        self.image_judgement.setTransparency(TransparencyAttrib.MAlpha)
-        #self.image_judgement.setPos(-0.7, 1, 0.6)
-        self.image_judgement.setAlphaScale(0)
+        self.popups = [JudgementPopup(self.tex_judgements["OK"]) for i in range(self.POPUP_POOL_SIZE)]
+        self.next_popup = 0
         
-        interval_pos = LerpPosInterval(self.image_judgement, duration=0.1, startPos=VBase3(-1.2, 1, 0.5), pos=VBase3(-0.7, 1, 0.5), blendType='easeOut')
-        interval_alpha = LerpFunc(self.image_judgement.setAlphaScale, duration=0.1, blendType='easeOut')
-        interval_fade = LerpFunc(self.image_judgement.setAlphaScale, fromData=1, toData=0, duration=1.0, blendType='easeOut')
+        self.timer = HudTimer()
         
-        self.judgement_enters = Sequence(Parallel(interval_pos, interval_alpha), Wait(1.0), interval_fade)
-
         ## Chain message
         text_node = TextNode('chain_msg')
-        text_node.setAlign(TextNode.ACenter)
+        text_node.setAlign(TextNode.ALeft)
         text_node.setFont(get_babelfish_font())
 
         text_node.setTextColor(1, 1, 0.16, .9)
         text_node.setShadow(0.05, 0.05)
         text_node.setShadowColor(0.05, 0, 0.43, .9)
         
-        self.chain_msg = aspect2d.attachNewNode(text_node)
+        self.chain_msg = aspect2d.attachNewNode('chain_msg')
         self.chain_msg.setPos(-.9, 1, 0.35)
         self.chain_msg.setScale(0.11)
         
+        self.chain_counter = NumericCounter(text_node, 4, self.chain_msg, pad=' ')
+        self.chain_label = DynamicText(text_node, self.chain_msg)
+        self.chain_label.set_text(" CHAIN")
         
-    def judgement_msg(self, msg, chain):
-        if self.judgement_enters.isPlaying():
-            self.judgement_enters.clearToInitial()
+        x = -(self.chain_counter.get_width() + text_node.calcWidth(" CHAIN"))/2
+        self.chain_counter.node.setX(x)
+        self.chain_label.np.setX(x + self.chain_counter.get_width())
+        self.chain_msg.stash()
         
-        self.image_judgement.setTexture(self.tex_judgements[msg])
-        self.judgement_enters.start()
         
-        if chain > 1:
-            self.chain_msg.node().setText("%d CHAIN" % chain)
+    def judgement_msg(self, msg, chain):
+        #o popup anterior sai e o mais antigo do pool eh reaproveitado
+        self.popups[self.next_popup - 1].retire()
+        self.popups[self.next_popup].show(self.tex_judgements[msg])
+        self.next_popup = (self.next_popup + 1) % len(self.popups)
         
-        taskMgr.add(self.task_ClearJudgementTask, "clear-judgement")
+        if chain > 1:
+            self.chain_counter.set_value(chain)
+            self.chain_msg.unstash()
         
-    def task_ClearJudgementTask(self, task):
-        if task.time < 1.5:
-            return Task.cont
-            
-        self.chain_msg.node().clearText()
+        self.timer.schedule('chain', self.CHAIN_TIMEOUT, self.chain_msg.stash)
+    
+    #tira da tela os popups e o chain (fim da fase)
+    def clear(self):
+        self.timer.cancel('chain')
+        self.chain_msg.stash()
+        for popup in self.popups:
+            popup.enters.finish()
+            popup.retires.finish()
     
     def __del__(self):
-        self.judgement_enters.finish()
-        self.image_judgement.destroy()
+        self.timer.destroy()
+        for popup in self.popups:
+            popup.destroy()
         self.chain_msg.removeNode()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import math
+from bisect import bisect_left, bisect_right
     
 import pygame
 from direct.task import Task
@@ -11,9 +13,13 @@ from direct.gui.OnscreenText import OnscreenText
 from panda3d.core import *
 from direct.interval.IntervalGlobal import *
 
+import audio
+import control
 import gui
 import parse
 import particle
+import quality
+import resources
 try:
     import cwiid_compat as cwiid
 except ImportError:
@@ -25,9 +31,11 @@ except ImportError:
 from utils import *
 
 class Level(DirectObject.DirectObject):
-    def __init__(self, name, options=None, difficulty="Normal", joystick=None, camera=base.camera, wm=None, b_training=False):
+    def __init__(self, name, options=None, difficulty="Normal", joystick=None, camera=base.camera, wm=None, b_training=False, rate=1.0):
         self.options = options
         self.bool_training = b_training
+        #velocidade da musica no treino (1.0 = normal)
+        self.rate = rate
         self.first = True
         
         if wm:
@@ -35,19 +43,19 @@ class Level(DirectObject.DirectObject):
         
         #booleano para teste de mouse
         self.bool_mouse = False
+        self.bool_mouse_relative = False
         
         #booleano para teste com wiimote
         self.bool_wiimote = False
         self.bool_wiimote_ir = False
         self.bool_nun_error = False
         
-        self.miss_time = 0.0
-        self.bool_miss = True
         self.angle_R = 0.0
         self.angle_P = 0.0
         
         if self.options.get('game-opts', 'controller') == 'Mouse':
             self.bool_mouse = True
+            self.bool_mouse_relative = self.options.get('game-opts', 'mouse-mode', fallback='relative') == 'relative'
         elif uses_wii(self.options):
             self.bool_wiimote = True
             if uses_wii_ir(self.options):
@@ -67,10 +75,51 @@ class Level(DirectObject.DirectObject):
         self.SPEED_SCALE = .08        
         
         self.CONTROL_UPDATE_DELAY = 1.0/60.0
+        
+        self.RUMBLE_PULSE = 0.12
+        
+        self.HIT_SOUND = './sound/hit_%s.wav'
+        
+        #latencia de audio medida na calibracao: desloca o julgamento e, opcionalmente,
+        #a posicao dos aneis e da trilha de botoes em relacao ao relogio da musica
+        self.JUDGEMENT_OFFSET = self.options.getfloat('game-opts', 'judgement-offset', fallback=0.0)
+        if self.options.get('game-opts', 'offset-visuals', fallback='off') == 'on':
+            self.VISUAL_OFFSET = self.JUDGEMENT_OFFSET
+        else:
+            self.VISUAL_OFFSET = 0.0
+        
+        #segundos de musica que o titulo e os banners do chart ficam na tela
+        self.TITLE_DURATION = 20.0
+        self.BANNER_DURATION = 2.5
+        self.title_msg = None
+        
+        #treino: teclas dos pontos A/B de repeticao e da busca, batidas tocadas antes
+        #do ponto A ao repetir e batidas puladas por busca
+        self.PRACTICE_KEYS = {
+            'loop-a': '1',
+            'loop-b': '2',
+            'loop-clear': '3',
+            'restart': 'backspace',
+            'seek-back': 'page_down',
+            'seek-forward': 'page_up',
+        }
+        self.LOOP_LEAD_IN = 2
+        self.SEEK_BEATS = 4
+        self.loop_a = 0.0
+        self.loop_b = None
     
         self.rootNode = render.attachNewNode("Level Root Node")
         
-        self.miss_sound = loader.loadSfx('./sound/miss.wav')
+        #varias vozes, para erros seguidos nao cortarem um ao outro
+        self.miss_sound = audio.get_audio_cache().get_sfx_voices('./sound/miss.wav')
+        
+        #sons de acerto por botao (opcionais, ./sound/hit_<botao>.wav)
+        self.hit_sounds = {}
+        if self.options.get('game-opts', 'hit-sounds', fallback='off') == 'on':
+            for button in ['A', 'B', 'C', 'D']:
+                path = self.HIT_SOUND % button.lower()
+                if os.path.exists(path):
+                    self.hit_sounds[button] = path
         
         self.name = name
         self.difficulty = difficulty
@@ -79,24 +128,27 @@ class Level(DirectObject.DirectObject):
 
         if self.bool_wiimote:
             if uses_nunchuk(self.options):
-                for i in range(1000):
-                    try:
-                        self.wm.state['nunchuk']['stick'][0]
-                    except KeyError:
-                        self.bool_nun_error = True
-                    else:
-                        self.bool_nun_error = False
+                #espera (no maximo meio segundo) pelo status da extensao
+                self.bool_nun_error = self.wm.wait_extension(timeout=0.5) != cwiid.EXT_NUNCHUK
             if self.bool_nun_error:
                 print("No Nunchuk conected, using standard Wiimote\n")
 
             self.cal = self.wm.get_acc_cal(cwiid.EXT_NONE)
 
-        if self.bool_mouse or self.bool_wiimote:
-            self.x_old = 300
-            self.y_old = 213
-            
-            base.win.movePointer(0, int(self.x_old), int(self.y_old))
-            self.mvs = ListMovements()
+        if self.bool_mouse_relative:
+            sensitivity = self.options.getfloat('game-opts', 'mouse-sensitivity', fallback=0.004)
+            self.mouse = control.RelativeMouse(base.win, sensitivity)
+        elif self.bool_mouse or self.bool_wiimote:
+            self.reset_pointer()
+
+    #ponteiro do mouse/Wiimote de volta ao centro, sem movimentos acumulados
+    def reset_pointer(self):
+        self.first = True
+        self.x_old = 300
+        self.y_old = 213
+        
+        base.win.movePointer(0, int(self.x_old), int(self.y_old))
+        self.mvs = ListMovements()
 
     def setup(self):
         self.setup_logic()
@@ -104,15 +156,27 @@ class Level(DirectObject.DirectObject):
         self.setup_gui()
         self.setup_rings()
         self.setup_events()
+        quality.get_governor().add_listener(self.apply_quality)
     
     def setup_logic(self):
         self.info = parse.level_header(self.name)
         
         #################
         ## Musica
-        self.music = loader.loadMusic(self.info["MUSIC_FILE"])
+        self.music = audio.get_audio_cache().get_music(self.info["MUSIC_FILE"], self.rate)
+        #a musica esticada toca em tempo real (a musica anda rate vezes o relogio do
+        #audio); sem ela, a velocidade vem do setPlayRate e o relogio ja eh o da musica
+        if self.music.getPlayRate() == 1.0:
+            self.clock_rate = self.rate
+        else:
+            self.clock_rate = 1.0
+        self.song_length = self.music.length()*self.clock_rate
         self.music_bpm = self.info["BPM"]
-        self.BEAT_DELAY = beat_delay(self.music_bpm)
+        self.tempo = TempoMap(self.music_bpm, self.info.get("TEMPO", []))
+        
+        #acoes agendadas pelo tempo da musica (disparadas em ctask_moveChar)
+        self.scheduler = SongScheduler(self.tempo)
+        self.banners = []
                 
         #################
         ## Pontuacao4o, Chain e Vida
@@ -159,7 +223,7 @@ class Level(DirectObject.DirectObject):
         #################
         ## Decoracoes de Tela
         self.deco_mgr = gui.ScreenDecorationManager()
-        self.btn_viewer = gui.ButtonViewer(self.music_bpm,z_pos=-0.8)
+        self.btn_viewer = gui.ButtonViewer(self.tempo,z_pos=-0.8)
         self.score_display = gui.ScoreDisplay()
 
     def setup_graphics(self):
@@ -229,7 +293,9 @@ class Level(DirectObject.DirectObject):
             terrain.reparentTo(self.rootNode)
             
             self.terrain_patch_list.append(terrain)
-
+        
+        #quantos trechos estao ativos (o governador de qualidade pode esconder os ultimos)
+        self.terrain_active = self.TERRAIN_PATCHES
         
         #################
         ## Fog
@@ -237,6 +303,7 @@ class Level(DirectObject.DirectObject):
         fog.setColor(Vec4(0.25, 0.80, 0.97, 1))
         fog.setExpDensity(.002)
         render.setFog(fog)
+        self.fog = fog
 
         #################
         ## Iluminacao
@@ -271,10 +338,9 @@ class Level(DirectObject.DirectObject):
         if self.bool_wiimote and not uses_nunchuk(self.options):
             self.accept("wii-button", self.check_button_press)
         elif uses_nunchuk(self.options):
-            if self.bool_nun_error:
-                self.accept("wii-button", self.check_button_press)
-            else:
-                self.accept("nunchuk-button", self.check_button_press)
+            #o ButtonMap troca entre wiimote e nunchuk quando a extensao eh conectada/desconectada
+            self.accept("wii-button", self.check_button_press)
+            self.accept("nunchuk-button", self.check_button_press)
 
         else:
             self.accept("arrow_left", self.setKey, ["left",1])
@@ -287,66 +353,95 @@ class Level(DirectObject.DirectObject):
             self.accept("arrow_up-up", self.setKey, ["up",0])
             self.accept("arrow_down-up", self.setKey, ["down",0])
             
-            self.accept("s", self.check_button_press, ['A'])
-            self.accept("d", self.check_button_press, ['B'])
-            self.accept("a", self.check_button_press, ['C'])
-            self.accept("w", self.check_button_press, ['D'])
-
+            self.accept("key-button", self.check_button_press)
             self.accept("joy-button", self.check_button_press)
         
         self.accept("music-finished", self.end)
         self.accept("escape", self.end)
         self.accept("wii-out", self.end)
         
+        if self.bool_training:
+            self.accept(self.PRACTICE_KEYS['loop-a'], self.set_loop_point, ['A'])
+            self.accept(self.PRACTICE_KEYS['loop-b'], self.set_loop_point, ['B'])
+            self.accept(self.PRACTICE_KEYS['loop-clear'], self.clear_loop)
+            self.accept(self.PRACTICE_KEYS['restart'], self.restart_section)
+            self.accept(self.PRACTICE_KEYS['seek-back'], self.seek_beats, [-self.SEEK_BEATS])
+            self.accept(self.PRACTICE_KEYS['seek-forward'], self.seek_beats, [self.SEEK_BEATS])
+        
     
     def setup_rings(self):
         ring_parsed_info = parse.level_rings(self.info["NAME"], self.difficulty)
         
-        self.ring_list = []
+        self.rings = []
+        self.ring_lookahead = 0
         for pos, beat, button in ring_parsed_info:
             ring = loader.loadModelCopy("./models/ring")
-            ring.setName('ring%d'%beat)
+            ring.setName('ring%d'%int(beat))
             #ring.setScale(0.8, 0.8, 0.8)
             
-            tex = loader.loadTexture('./image/envmap.jpg')
-            ring.setTexGen(TextureStage.getDefault(), TexGenAttrib.MEyeSphereMap)
-            ring.setTexture(tex)
-            
             ringY = beat*self.RING_SPACING_PER_BEAT
             self.btn_viewer.append_button(button, beat)
             
             ring.setX(pos[0]*self.FLY_AREA_W)
             ring.setZ(pos[1]*self.FLY_AREA_H)
             
-            color = None
-            
-            if button == 'A':
-                color = (.4, .44, .81, 1)
-            elif button == 'B':
-                color = (1, .3, .3, 1)
-            elif button == 'C':
-                color = (.99, .0, 1, 1)
-            elif button == 'D':
-                color = (.39, 1, .62, 1)
-            
             ring.setY(ringY)
             ring.reparentTo(self.rootNode)
-            ring.setColor(VBase4(*color))
+            #envmap e cor compartilhados por todos os aneis do mesmo botao
+            ring.setState(resources.get_ring_state(button))
 
-            self.ring_list.append({"node":ring, "time":beat*self.BEAT_DELAY, "button":button, "cleared": False})#+adjust, "button":button, "cleared": False})
+            self.rings.append({"node":ring, "beat":beat, "time":self.tempo.beat2time(beat), "button":button, "cleared": False, "judgement": None, "points": 0})#+adjust, "button":button, "cleared": False})
+        
+        #linha do tempo indexada: rings[next_ring] eh o proximo anel a julgar, os
+        #aneis ate ring_shown estao visiveis e os instantes/batidas ficam em listas
+        #ordenadas para a busca binaria do seek
+        self.ring_times = [r["time"] for r in self.rings]
+        self.ring_beats = [r["beat"] for r in self.rings]
+        self.next_ring = 0
+        self.ring_shown = len(self.rings)
         
-        ring = self.ring_list[0]["node"]
+        ring = self.rings[0]["node"]
         
         self.ring_radius = ring.node().getBounds().getRadius()
                 
-        self.n_rings = len(self.ring_list)
+        self.n_rings = len(self.rings)
+        
+        self.chart_events = parse.level_events(self.info["NAME"], self.difficulty)
+        self.chart_events.sort(key=lambda e: e[0])
+        self.event_times = [self.tempo.beat2time(beat) for beat, event, arg in self.chart_events]
+        self.schedule_events(0.0)
+    
+    #agenda os eventos do chart a partir do instante time
+    def schedule_events(self, time):
+        self.scheduler.reset(time)
+        for i in range(bisect_left(self.event_times, time), len(self.chart_events)):
+            beat, event, arg = self.chart_events[i]
+            self.scheduler.at(self.event_times[i], self.chart_event, event, arg)
+    
+    def chart_event(self, event, arg):
+        if event == "BANNER":
+            banner = gui.TitleMessage(arg, "")
+            self.banners.append(banner)
+            self.scheduler.after(self.BANNER_DURATION*self.rate, self.clear_banner, banner)
+    
+    def clear_banner(self, banner):
+        if banner in self.banners:
+            self.banners.remove(banner)
+            banner.clear()
+    
+    def clear_title(self):
+        if self.title_msg:
+            self.title_msg.clear()
+            self.title_msg = None
     
     def setKey(self, key, value):
         self.button_map[key] = value
     
     def play(self):
+        self.music.setFinishedEvent("music-finished")
         self.music.play()
         self.title_msg = gui.TitleMessage(self.info["TITLE"], "by %s" % self.info["ARTIST"])
+        self.scheduler.at(self.TITLE_DURATION*self.rate, self.clear_title)
         
         self.task_list = [name for name in self.__class__.__dict__.keys() if name.startswith("ctask_")]
         
@@ -378,11 +473,86 @@ class Level(DirectObject.DirectObject):
 
         return rank
 
+    #instante da musica (s), descontando latency segundos reais; o chart, o
+    #agendador e a posicao do coelho usam sempre esse tempo, e as janelas de
+    #julgamento sao medidas em tempo real (distancia/rate)
+    def song_time(self, latency=0.0):
+        return self.music.getTime()*self.clock_rate - latency*self.rate
+    
+    #reposiciona a propria musica no instante time: o AudioSound (e o cursor que
+    #ele mantem aberto na fonte) eh reaproveitado, sem abrir a fonte de novo nem
+    #copiar o PCM
+    def seek_music(self, time):
+        self.music.setFinishedEvent("")
+        self.music.stop()
+        self.music.setTime(time/self.clock_rate)
+    
+    #salta para o instante time da musica sem reconstruir a cena: o cursor de
+    #julgamento, os aneis visiveis e os eventos sao achados por busca binaria, os
+    #aneis ja passados voltam a valer (desfazendo os julgamentos e os pontos deles)
+    #e o terreno eh recolocado sob a camera
+    def seek(self, time):
+        time = clamp(0.0, time, self.song_length)
+        
+        cursor = bisect_left(self.ring_times, time)
+        #so os aneis ate o cursor atual (inclusive, que pode ja ter sido acertado)
+        #tem julgamento; voltando, a sequencia de acertos tambem recomeca
+        if cursor <= self.next_ring:
+            self.chain = 0
+        for ring in self.rings[cursor:self.next_ring + 1]:
+            if ring["judgement"] is not None:
+                self.judgement_stats[ring["judgement"]] -= 1
+                self.score -= ring["points"]
+                ring["judgement"] = None
+                ring["points"] = 0
+            ring["cleared"] = False
+        self.score_display.update(self.score)
+        self.next_ring = cursor
+        
+        self.seek_music(time)
+        self.music.setFinishedEvent("music-finished")
+        self.music.play()
+        
+        self.clear_title()
+        for banner in list(self.banners):
+            self.clear_banner(banner)
+        self.schedule_events(time)
+        
+        self.update_visible_rings(time)
+        self.reset_terrain(self.tempo.time2pos(time, self.RING_SPACING_PER_BEAT) - self.camera_offset)
+    
+    def seek_beats(self, beats):
+        self.seek(self.tempo.beat2time(max(self.tempo.time2beat(self.song_time()) + beats, 0)))
+    
+    #pontos de repeticao nas batidas inteiras: A na anterior e B na seguinte
+    def set_loop_point(self, point):
+        beat = self.tempo.time2beat(self.song_time())
+        if point == 'A':
+            self.loop_a = self.tempo.beat2time(math.floor(beat))
+            if self.loop_b is not None and self.loop_b <= self.loop_a:
+                self.loop_b = None
+        else:
+            loop_b = self.tempo.beat2time(math.ceil(beat))
+            if loop_b <= self.loop_a:
+                return
+            self.loop_b = loop_b
+        self.chart_event("BANNER", "loop %s" % point)
+    
+    def clear_loop(self):
+        self.loop_a = 0.0
+        self.loop_b = None
+        self.chart_event("BANNER", "loop off")
+    
+    #volta LOOP_LEAD_IN batidas antes do ponto A (o comeco da musica, sem A)
+    def restart_section(self):
+        self.seek(self.tempo.beat2time(max(self.tempo.time2beat(self.loop_a) - self.LOOP_LEAD_IN, 0)))
+    
     def ctask_moveChar(self, task):
-        music_time = self.music.getTime()
-        if music_time > 20:
-            #print music_time, self.bunnyActor.getY(), self.bunnyActor.getX()
-            self.title_msg.clear()
+        music_time = self.song_time()
+        if self.loop_b is not None and music_time >= self.loop_b:
+            self.restart_section()
+            music_time = self.song_time()
+        self.scheduler.update(music_time)
 
         if (task.time - self.bunnyActor.last_update) > self.CONTROL_UPDATE_DELAY:
             s_x = self.button_map.get_axis(0)*self.SPEED_SCALE
@@ -415,7 +585,9 @@ class Level(DirectObject.DirectObject):
                     self.bunnyActor.loop("fly")
 
             #controles
-            if self.bool_mouse:
+            if self.bool_mouse_relative:
+                self.control_mouse_relative()
+            elif self.bool_mouse:
                 self.control_mouse()
             elif self.bool_wiimote:
                 if self.bool_wiimote_ir:
@@ -430,9 +602,10 @@ class Level(DirectObject.DirectObject):
             self.bunnyActor.last_update = task.time
         
         
-        bunny_pos = time2pos(music_time, self.BEAT_DELAY, self.RING_SPACING_PER_BEAT)
+        visual_time = self.song_time(self.VISUAL_OFFSET)
+        bunny_pos = self.tempo.time2pos(visual_time, self.RING_SPACING_PER_BEAT)
         self.bunnyActor.setY(bunny_pos)
-        self.btn_viewer.update(music_time)
+        self.btn_viewer.update(visual_time)
         
         self.camera.setY(self.bunnyActor.getY() - self.camera_offset)
         self.skybox.setY(self.bunnyActor.getY())
@@ -441,10 +614,37 @@ class Level(DirectObject.DirectObject):
 
     
 
-    #Rotina para controle de movimento com o Mouse
+    #Rotina para controle de movimento com o Mouse em modo relativo (sem mover o ponteiro)
+    def control_mouse_relative(self):
+        dx, dy = self.mouse.get_delta()
+        
+        self.bunnyActor.setX(clamp(self.FLY_AREA_L, self.bunnyActor.getX() + dx, self.FLY_AREA_R))
+        self.bunnyActor.setZ(clamp(self.FLY_AREA_B, self.bunnyActor.getZ() - dy, self.FLY_AREA_T))
+        
+        #animacao
+        if dx < 0:
+            self.bunnyActor.setR(15)
+            if self.bunnyActor.getCurrentAnim() != "turn-left":
+                self.bunnyActor.loop("turn-left")
+        elif dx > 0:
+            self.bunnyActor.setR(-15)
+            if self.bunnyActor.getCurrentAnim() != "turn-right":
+                self.bunnyActor.loop("turn-right")
+        
+        if dy < 0:
+            self.bunnyActor.setP(-10)
+            if self.bunnyActor.getCurrentAnim() != "rise":
+                self.bunnyActor.loop("rise")
+        elif dy > 0:
+            self.bunnyActor.setP(+10)
+            if self.bunnyActor.getCurrentAnim() != "dive":
+                self.bunnyActor.loop("dive")
+
+    #Rotina para controle de movimento com o Mouse (posicao absoluta do ponteiro)
     def control_mouse(self):
-        x = base.win.getPointer(0).getX()
-        y = base.win.getPointer(0).getY()
+        pointer = base.win.getPointer(0)
+        x = pointer.getX()
+        y = pointer.getY()
         
         mouse_factor = 240.0
 
@@ -793,35 +993,74 @@ class Level(DirectObject.DirectObject):
 
 
 
+    def apply_quality(self, settings):
+        #neblina e plano de corte, sem cortar o skybox
+        self.fog.setExpDensity(settings['fog-density'])
+        skybox_radius = self.skybox.getBounds().getRadius()*self.skybox.getScale().getX()
+        far = max(settings['far'], skybox_radius + abs(self.skybox.getZ()) + self.camera_offset)
+        base.cam.node().getLens().setFar(far)
+        
+        #trechos de terreno ativos
+        n_patches = clamp(1, settings['terrain-patches'], self.TERRAIN_PATCHES)
+        if n_patches != self.terrain_active:
+            first_y = self.terrain_patch_list[0].getY()
+            for i, patch in enumerate(self.terrain_patch_list):
+                if i < n_patches:
+                    patch.unstash()
+                    patch.setY(first_y + i*(self.terrain_patch_size - 0.1))
+                else:
+                    patch.stash()
+            self.terrain_active = n_patches
+        
+        #aneis visiveis a frente do coelho
+        self.ring_lookahead = settings['ring-lookahead']
+        self.update_visible_rings(self.song_time())
+    
+    #mostra apenas os aneis ate ring_lookahead batidas a frente (0 = todos)
+    def update_visible_rings(self, pos):
+        if self.ring_lookahead:
+            limit = self.tempo.time2beat(pos) + self.ring_lookahead
+        else:
+            limit = float('inf')
+        
+        shown = bisect_right(self.ring_beats, limit)
+        for ring in self.rings[self.ring_shown:shown]:
+            ring["node"].unstash()
+        for ring in self.rings[shown:self.ring_shown]:
+            ring["node"].stash()
+        self.ring_shown = shown
+    
+    #recoloca os trechos de terreno ativos em sequencia, a partir do que fica sob a camera
+    def reset_terrain(self, camera_y):
+        step = self.terrain_patch_size - 0.1
+        first = max(0, int((camera_y - 24)/step))
+        for i, patch in enumerate(self.terrain_patch_list[:self.terrain_active]):
+            patch.setY(24 - 0.1 + (first + i)*step)
+
     def ctask_terrainPatch(self, task):
         closest_patch = self.terrain_patch_list[0]
         
         if camera.getPos().getY() > closest_patch.node().getBounds().getCenter().getY() + closest_patch.node().getBounds().getRadius():
-            last_patch = self.terrain_patch_list[-1]
+            last_patch = self.terrain_patch_list[self.terrain_active - 1]
             closest_patch.setY(last_patch.getPos().getY() + self.terrain_patch_size -0.1)
             
-            self.terrain_patch_list.append(self.terrain_patch_list.pop(0))
+            self.terrain_patch_list.insert(self.terrain_active - 1, self.terrain_patch_list.pop(0))
             
         return Task.cont
     
     def ctask_checkNextRing(self, task):
-        pos = self.music.getTime()
+        pos = self.song_time(self.JUDGEMENT_OFFSET)
+        self.update_visible_rings(pos)
         
-        if uses_wii(self.options):
-            if self.bool_miss:
-                if pos - self.miss_time >= 0.5:
-                    self.wm.rumble = 0
-                    self.bool_miss = False
-                    #print "rumble off"
-        
-        if self.ring_list:
-            ring = self.ring_list[0]
+        if self.next_ring < len(self.rings):
+            ring = self.rings[self.next_ring]
             
-            if ring["time"] - pos < -0.11:
+            if (ring["time"] - pos)/self.rate < -0.11:
                 if not ring["cleared"]:
                     self.miss_sound.play()
                     self.chain = 0
                     self.judgement_stats["MISS"] += 1
+                    ring["judgement"] = "MISS"
                     self.deco_mgr.judgement_msg("MISS", self.chain)
                     
                     ring_x = ring["node"].getX()
@@ -834,43 +1073,103 @@ class Level(DirectObject.DirectObject):
                     
                     #rumble
                     if uses_wii(self.options):
-                        self.bool_miss = True
-                        self.wm.rumble = 1
-                        self.miss_time = pos
-                self.ring_list.pop(0)                
+                        self.wm.rumble_pulse(self.RUMBLE_PULSE)
+                self.next_ring += 1
                 
         return Task.cont
     
-    def ctask_checkEnd(self, task):
-        if self.music.status() == 1:
-            messenger.send("music-finished")
-        return Task.cont
-    
+    #termina a partida; a cena, o ator, o audio e o chart continuam carregados
+    #(escondidos) para reset() ou ate destroy()
     def end(self):
-        if self.title_msg:
-            self.title_msg.clear()
-        self.rootNode.node().removeAllChildren()
+        self.scheduler.clear()
+        self.clear_title()
+        for banner in list(self.banners):
+            self.clear_banner(banner)
+        self.rootNode.stash()
+        self.bunnyActor.stop()
+        self.btn_viewer.hide()
+        self.score_display.hide()
+        self.deco_mgr.clear()
+        self.music.setFinishedEvent("")
         self.music.stop()
         
         if uses_wii(self.options):
-            if self.bool_miss:
-                self.wm.rumble = 0
+            self.wm.rumble = 0
+        #devolve o ponteiro para os menus
+        if self.bool_mouse_relative:
+            self.mouse.release()
         
         for t in self.task_list:
             taskMgr.remove(t)
+        self.button_map.cleanup()
         messenger.send("level-finished")
         
         self.ignoreAll()
+    
+    #recomeca do zero (pontuacao, vida, cursor dos aneis, coelho, ponteiro, camera e musica)
+    #sem recarregar nada do disco
+    def reset(self):
+        self.score = 0
+        self.chain = 0
+        self.max_chain = 0
+        self.life = 7
+        for judgement in self.judgement_stats:
+            self.judgement_stats[judgement] = 0
+        self.score_display.update(0)
+        
+        for ring in self.rings:
+            ring["cleared"] = False
+            ring["judgement"] = None
+            ring["points"] = 0
+        self.next_ring = 0
+        self.loop_a = 0.0
+        self.loop_b = None
+        
+        self.bunnyActor.setPosHpr(.0, .0, .0, 180, 0, 0)
+        self.bunnyActor.last_update = 0
+        self.bunnyActor.loop("fly")
+        self.camera.setY(-self.camera_offset)
+        
+        #o mesmo AudioSound volta ao comeco, quantas vezes a fase for repetida
+        self.seek_music(0.0)
+        self.schedule_events(0.0)
+        self.update_visible_rings(0.0)
+        self.reset_terrain(-self.camera_offset)
+        if self.bool_mouse_relative:
+            self.mouse.capture()
+        elif self.bool_mouse or self.bool_wiimote:
+            self.reset_pointer()
+        
+        self.rootNode.unstash()
+        self.btn_viewer.show()
+        self.score_display.show()
+        
+        self.setup_events()
+        self.play()
+    
+    def destroy(self):
+        quality.get_governor().remove_listener(self.apply_quality)
+        if self.bool_mouse_relative:
+            self.mouse.release()
+        self.rootNode.removeNode()
+        #os nos do HUD sao removidos pelos __del__ dos objetos do gui
+        del self.btn_viewer
+        del self.score_display
+        del self.deco_mgr
                 
-    def check_button_press(self, button):        
-        time = self.music.getTime()
-        if self.ring_list:
+    #stamp: instante (globalClock.getRealTime) em que o botao foi apertado
+    def check_button_press(self, button, stamp=None):        
+        latency = self.JUDGEMENT_OFFSET
+        if stamp is not None:
+            latency += globalClock.getRealTime() - stamp
+        time = self.song_time(latency)
+        if self.next_ring < len(self.rings):
             hit = False
             
-            next_ring = self.ring_list[0]
+            next_ring = self.rings[self.next_ring]
             
             if not next_ring["cleared"]:
-                time_dist = abs(next_ring["time"] - time)
+                time_dist = abs(next_ring["time"] - time)/self.rate
                 
                 ring_x = next_ring["node"].getX()
                 ring_z = next_ring["node"].getZ()
@@ -901,7 +1200,8 @@ class Level(DirectObject.DirectObject):
 
                     score = self.score_map[judgement]
                     if score > 0:
-                        self.score += score + int(self.chain*0.02*score)
+                        next_ring["points"] = score + int(self.chain*0.02*score)
+                        self.score += next_ring["points"]
                         self.score_display.update(self.score)
                         
                         self.btn_viewer.button_hit()
@@ -909,21 +1209,28 @@ class Level(DirectObject.DirectObject):
                     if judgement == 'MISS':
                         self.miss_sound.play()
                         if uses_wii(self.options):
-                            self.bool_miss = True
-                            self.wm.rumble = 1
-                            self.miss_time = time
+                            self.wm.rumble_pulse(self.RUMBLE_PULSE)
+                    elif next_ring["button"] in self.hit_sounds:
+                        audio.get_audio_cache().play_sfx(self.hit_sounds[next_ring["button"]])
+                            
+                    if judgement == 'PERFECT':
+                        particle.get_particle_manager().burst('hit', self.rootNode, next_ring["node"].getPos())
                             
                     self.judgement_stats[judgement] += 1
+                    next_ring["judgement"] = judgement
                     self.deco_mgr.judgement_msg(judgement, self.chain)
 
 class ButtonMap:
     def __init__(self, options, j_id=0, wm=None, b_nunc = False):
         self.options = options
+        self.queue = control.get_input_queue()
         
         self.wii = False
         if wm:
             self.wm = wm
             self.wii = True
+            self.wii_buttons = [(cwiid.BTN_UP, 'up'), (cwiid.BTN_DOWN, 'down'), (cwiid.BTN_LEFT, 'left'),
+                                (cwiid.BTN_RIGHT, 'right'), (cwiid.BTN_HOME, 'home')]
         
         if self.options.get('game-opts', 'controller') == 'Joypad':
             self.mode = 'joy'
@@ -940,16 +1247,12 @@ class ButtonMap:
             self.mode = 'key'
         
         if self.mode == 'joy':
-            pygame.init()
-            pygame.joystick.init()
-            print(pygame.joystick)
-        
             try:
-                if self.mode == "joy":
-                    self.joy = pygame.joystick.Joystick(j_id)
-                    self.joy.init()
+                self.joy_id = j_id
+                self.joy_service = control.get_joystick_service()
+                self.joy_service.open(j_id)
                 
-                    taskMgr.add(self.ctask_JoyEvent, "joy-event")
+                taskMgr.add(self.ctask_JoyEvent, "joy-event")
             except pygame.error as e:
                 print(e)
                 self.mode = 'key'
@@ -958,6 +1261,9 @@ class ButtonMap:
             taskMgr.add(self.ctask_WiiEvent, "wii-event")
         elif self.wii and self.mode == 'nunchuk':
             taskMgr.add(self.ctask_NunchukEvent, "nunchuk-event")
+        
+        if self.wii and uses_nunchuk(self.options):
+            taskMgr.add(self.ctask_ExtEvent, "wii-ext-event")
 
         self.buttons = {
             "left":0,
@@ -968,6 +1274,36 @@ class ButtonMap:
             
     def setMode(self, mode):
         self.mode = mode
+    
+    #troca entre os modos 'wiimote' e 'nunchuk' quando o nunchuk eh conectado/desconectado
+    def set_extension(self, ext_type):
+        if ext_type == cwiid.EXT_NUNCHUK and self.mode != 'nunchuk':
+            taskMgr.remove("wii-event")
+            self.queue.reset('wii')
+            taskMgr.add(self.ctask_NunchukEvent, "nunchuk-event")
+            self.mode = 'nunchuk'
+            print("Nunchuk connected")
+        elif ext_type != cwiid.EXT_NUNCHUK and self.mode == 'nunchuk':
+            taskMgr.remove("nunchuk-event")
+            self.queue.reset('nunchuk')
+            taskMgr.add(self.ctask_WiiEvent, "wii-event")
+            self.mode = 'wiimote'
+            print("Nunchuk disconnected, using standard Wiimote")
+    
+    def ctask_ExtEvent(self, task):
+        for event, ext_type in self.wm.get_ext_events():
+            if event == cwiid.EXT_ATTACHED:
+                self.set_extension(ext_type)
+            else:
+                self.set_extension(cwiid.EXT_NONE)
+        
+        return Task.cont
+        
+    def cleanup(self):
+        for t in ["joy-event", "wii-event", "nunchuk-event", "wii-ext-event"]:
+            taskMgr.remove(t)
+        for device in ['joy', 'wii', 'nunchuk']:
+            self.queue.reset(device)
         
     def __setitem__(self, key, value):
         self.buttons[key] = value
@@ -989,64 +1325,44 @@ class ButtonMap:
             return value
             
         elif self.mode == "joy":
-            return self.joy.get_axis(axis)
+            return self.joy_service.get_axis(self.joy_id, axis)
         
+    #os tasks abaixo apenas leem o estado dos dispositivos; a fila de entrada
+    #gera um unico evento por aperto
     def ctask_JoyEvent(self, task):
-        pygame.event.pump()
-        
-        if self.joy.get_button(2): messenger.send("joy-button", ["A"])
-        if self.joy.get_button(1): messenger.send("joy-button", ["B"])
-        if self.joy.get_button(3): messenger.send("joy-button", ["C"])
-        if self.joy.get_button(0): messenger.send("joy-button", ["D"])
+        buttons = self.joy_service.buttons[self.joy_id]
+        pressed = [('b', i) for i, b in enumerate(buttons) if b]
+        self.queue.update('joy', pressed)
             
         return Task.cont
 
     def ctask_WiiEvent(self, task):
         #mapeamento dos botoes para o direcional do wiimote
-        #Quadrado
-        if self.wm.state['buttons'] == cwiid.BTN_LEFT: 
-            messenger.send("wii-button", ["C"])
-        
-        #Xis
-        if self.wm.state['buttons'] == cwiid.BTN_DOWN:
-            messenger.send("wii-button", ["A"])
-            
-        #Circulo
-        if self.wm.state['buttons'] == cwiid.BTN_RIGHT:
-            messenger.send("wii-button", ["B"])
-        
-        #Triangulo
-        if self.wm.state['buttons'] == cwiid.BTN_UP:
-            messenger.send("wii-button", ["D"])
-
-        if self.wm.state['buttons'] == cwiid.BTN_HOME:
-            messenger.send("wii-out")
+        buttons = self.wm.state['buttons']
+        self.queue.update('wii', [name for mask, name in self.wii_buttons if buttons & mask])
         
         return Task.cont
 
     def ctask_NunchukEvent(self, task):
-        #mapeamento dos botoes para o direcional do wiimote
-        #Quadrado
+        #mapeamento do analogico do nunchuk para os botoes
+        pressed = []
         try:
-            if self.wm.state['nunchuk']['stick'][0] < 50: 
-                messenger.send("nunchuk-button", ["C"])
-            
-            #Xis
-            elif self.wm.state['nunchuk']['stick'][1] < 50: 
-                messenger.send("nunchuk-button", ["A"])
-                
-            #Circulo
-            elif self.wm.state['nunchuk']['stick'][0] >200: 
-                messenger.send("nunchuk-button", ["B"])
-                
-            #Triangulo
-            elif self.wm.state['nunchuk']['stick'][1] > 200: 
-                messenger.send("nunchuk-button", ["D"])
-
+            stick = self.wm.state['nunchuk']['stick']
+            if stick[0] < 50: 
+                pressed.append('left')
+            elif stick[1] < 50: 
+                pressed.append('down')
+            elif stick[0] > 200: 
+                pressed.append('right')
+            elif stick[1] > 200: 
+                pressed.append('up')
         except KeyError:
             pass
+        self.queue.update('nunchuk', pressed)
         
-        if self.wm.state['buttons'] == cwiid.BTN_HOME:
-            messenger.send("wii-out")
+        if self.wm.state['buttons'] & cwiid.BTN_HOME:
+            self.queue.update('wii', ['home'])
+        else:
+            self.queue.update('wii', [])
 
         return Task.cont
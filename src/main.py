@@ -40,6 +40,12 @@ loadPrcFile("./config.prc")
 # Add the current directory to Panda3D's model path so it can find assets
 getModelPath().appendDirectory(".")
 
+#o framebuffer multisample depende do preset de qualidade e precisa ser pedido
+#antes de a janela abrir
+import options
+import quality
+quality.request_multisample(options.MoonBunnyOptions())
+
 import direct.directbase.DirectStart
 from direct.task import Task
 from direct.actor import Actor
@@ -55,12 +61,15 @@ props = WindowProperties()
 props.setCursorHidden(True) 
 base.win.requestProperties(props)
 
+import audio
 import control
 
 from level import *
 from screens import *
 
-import options
+import parse
+import particle
+import resources
 
 class Game(FSM.FSM):
     def __init__(self):
@@ -73,7 +82,8 @@ class Game(FSM.FSM):
         self.defaultTransitions = {
             'Title' : [ 'Options', 'Training', 'LevelSelect', 'Exit' ],
             'Training': [ 'Load', 'Title', 'Options', 'Result'],
-            'Options' : [ 'Title' , 'Level'],
+            'Options' : [ 'Title' , 'Level', 'Calibration'],
+            'Calibration' : [ 'Options' ],
             'LevelSelect' : [ 'Level', 'Title'],
             'Load' : ['LevelSelect','Training', 'Level'],
             'Level' : [ 'Result', 'Load', 'Options'],
@@ -81,13 +91,15 @@ class Game(FSM.FSM):
             }
 
         self.options = options.MoonBunnyOptions()
-        self.start_level_sfx = loader.loadSfx('./sound/start_level.wav')
-        self.theme = loader.loadMusic('./sound/always.wav')
+        self.screens = {}
+        quality.get_governor(self.options)
+        particle.get_particle_manager()
+        self.start_level_sfx = audio.get_audio_cache().get_sfx('./sound/start_level.wav')
+        self.theme = audio.get_audio_cache().get_music('./sound/always.wav')
         self.theme.setLoop(True)
         
-        logo_sound= loader.loadSfx('./sound/elefante.wav')
-        self.logo = OnscreenImage(image='./image/tromba_logo.png', scale=(512.0/base.win.getXSize(), 1 ,256.0/base.win.getYSize()), pos = (0.0, 2.0, 0.0), parent=render2d)
-        self.logo.setTransparency(TransparencyAttrib.MAlpha)                
+        logo_sound= audio.get_audio_cache().get_sfx('./sound/elefante.wav')
+        self.logo = resources.make_image('./image/tromba_logo.png', scale=(512.0/base.win.getXSize(), 1 ,256.0/base.win.getYSize()), pos = (0.0, 2.0, 0.0), parent=render2d)
         Sequence( 
                 LerpFunc(self.logo.setAlphaScale, fromData=.0, toData=1, duration=.5),
                 SoundInterval(logo_sound, duration=4.0),
@@ -95,6 +107,14 @@ class Game(FSM.FSM):
                 Func(self.request,'Title')
                 ).start()
     
+    #as telas sao criadas na primeira vez e depois so escondidas/mostradas
+    def show_screen(self, name, factory, *args):
+        if name in self.screens:
+            self.screens[name].show(*args)
+        else:
+            self.screens[name] = factory(*args)
+        return self.screens[name]
+
     def connect_wii(self, end):
         try:
             self.wm = cwiid.Wiimote(end)
@@ -106,10 +126,10 @@ class Game(FSM.FSM):
         if self.theme.status() == 1:
             self.theme.play()
 
-        self.title_screen = TitleScreen()
+        self.title_screen = self.show_screen('Title', TitleScreen)
         
     def exitTitle(self):
-        self.title_screen.clear()
+        self.title_screen.hide()
 
     def filterTitle(self, request, args):
         if request == 'nav-up' or request == 'nav-down':
@@ -121,7 +141,7 @@ class Game(FSM.FSM):
             if self.title_screen.option_pressed() == 'start':
                 return ("LevelSelect")
             if self.title_screen.option_pressed() == 'training':
-                return ("Load", 't')
+                return ("LevelSelect", True)
             if self.title_screen.option_pressed() == 'options':
                 return 'Options'
             if self.title_screen.option_pressed() == 'exit':
@@ -131,46 +151,90 @@ class Game(FSM.FSM):
             return 'Exit'
         
     ## LevelSelect state
-    def enterLevelSelect(self):
+    #practice: escolha de fase para o treino, com a velocidade da musica
+    def enterLevelSelect(self, practice=False):
         if self.theme.status() == 1:
             self.theme.play()
-        self.level_select = LevelSelectScreen(self.options)
+        self.level_select = self.show_screen('LevelSelect', lambda practice: LevelSelectScreen(self.options, self.theme, practice), practice)
         
     def exitLevelSelect(self):
-        self.level_select.clear()
+        self.level_select.hide()
         
     def filterLevelSelect(self, request, args):
         if request == 'nav-confirm':
             level_name = self.level_select.option_pressed()
+            if self.level_select.practice:
+                self.options.save()
+                return ("Load", 't', level_name, self.level_select.selected_rate())
             return ("Load", 's', level_name)
         if request == 'nav-back':
             return 'Title'
         if request == 'nav-left'or request == 'nav-right':
             self.level_select.option_changed(request.replace('nav-', ''))
+        if (request == 'nav-up' or request == 'nav-down') and self.level_select.practice:
+            self.level_select.rate_changed(request.replace('nav-', ''))
 
     
     ## Options state
     def enterOptions(self):
-        self.options_screen = OptionsScreen(self.options)
+        self.options_screen = self.show_screen('Options', lambda: OptionsScreen(self.options))
         
     def exitOptions(self):
-        self.options_screen.clear()
+        self.options_screen.apply()
+        self.options_screen.hide()
         self.options.save()
         
     def filterOptions(self, request, args):
+        if request == 'nav-up' or request == 'nav-down':
+            self.options_screen.row_changed(request)
         if request == 'nav-left' or request == 'nav-right':
             self.options_screen.option_changed(request)
+        if request == 'nav-confirm' and self.options_screen.selected_row() == 'calibrate':
+            return 'Calibration'
         if request == 'nav-back' or request == 'nav-confirm':
             return 'Title'
 
+    ## Calibration state
+    def enterCalibration(self):
+        #o metronomo precisa de silencio
+        self.theme.stop()
+        wm = None
+        if b_cwiid and uses_wii(self.options):
+            self.connect_wiimote(wm_addr)
+            wm = self.wm
+        self.calibration_screen = self.show_screen('Calibration', lambda wm: CalibrationScreen(self.options, wm), wm)
+        
+    def exitCalibration(self):
+        self.calibration_screen.hide()
+        if uses_wii(self.options) and self.wm is not None:
+            self.wm.led = 0
+        if self.theme.status() == 1:
+            self.theme.play()
+        
+    def filterCalibration(self, request, args):
+        if request == 'nav-confirm' and self.calibration_screen.finished:
+            if self.calibration_screen.result is None:
+                self.calibration_screen.start()
+            else:
+                self.calibration_screen.apply()
+                self.options.save()
+                return 'Options'
+        if request == 'nav-back':
+            return 'Options'
+
     
     ## Load state
-    def enterLoad(self, tipo, l_n=''):
+    def enterLoad(self, tipo, l_n='', rate=1.0):
         if self.theme.status() == 1:
             self.theme.play()
-        self.load_screen = LoadScreen(self.options)
+        self.load_screen = self.show_screen('Load', lambda: LoadScreen(self.options))
         self.tipo = tipo
         self.level_name = l_n
+        self.rate = rate
+        
+        #a musica da fase vai sendo decodificada (e esticada, no treino com outra
+        #velocidade) enquanto o jogador le as instrucoes
+        audio.get_audio_cache().prefetch(parse.level_header(l_n)["MUSIC_FILE"], rate)
         
     def exitLoad(self):
         pass
@@ -180,10 +244,10 @@ class Game(FSM.FSM):
             if self.tipo == 's':
                 return ('Level', self.level_name, 'Normal', self.load_screen)
             elif self.tipo == 't':
-                return ('Training', 'rain_of_love', 'Normal', self.load_screen)
+                return ('Training', self.level_name, 'Normal', self.load_screen, self.rate)
 
         if request == 'nav-back':
-            self.load_screen.clear()
+            self.load_screen.hide()
             return 'Title'    
     
 
@@ -205,26 +269,28 @@ class Game(FSM.FSM):
                 self.wm.rpt_mode = cwiid.RPT_BTN | cwiid.RPT_ACC
 
     ## Training state
-    def enterTraining(self, level, difficulty, load_screen):
+    def enterTraining(self, level, difficulty, load_screen, rate=1.0, retry=False):
         self.theme.stop()
+        if retry:
+            self.retry_level()
+            return
         self.ls = load_screen
 
         #verifica se a cwiid esta instalada na maquina e se o controle escolhido eh envolve o Wiimote
         if b_cwiid and uses_wii(self.options):
             self.connect_wiimote(wm_addr)
-            self.level = Level(level, difficulty=difficulty, options=self.options, wm=self.wm, b_training=True)
+            self.level = Level(level, difficulty=difficulty, options=self.options, wm=self.wm, b_training=True, rate=rate)
         #caso nao utilize o Wiimote
         else:
-            self.level = Level(level, difficulty=difficulty, options=self.options, b_training = True)
+            self.level = Level(level, difficulty=difficulty, options=self.options, b_training = True, rate=rate)
         
-        Sequence(Func(self.ls.clear), SoundInterval(self.start_level_sfx), Func(self.level.setup), Func(self.level.play)).start()
+        Sequence(Func(self.ls.hide), SoundInterval(self.start_level_sfx), Func(self.level.setup), Func(self.level.play)).start()
 
     def exitTraining(self):
+        self.level_practice = True
         self.level_name = self.level.name
         self.level_score = self.level.score
-        self.rank_stats = (self.level.judgement_stats, self.level.n_rings)
-        del self.level
-        self.level = None
+        self.rank_stats = (dict(self.level.judgement_stats), self.level.n_rings)
         if uses_wii(self.options):
             self.wm.led = 0
         
@@ -232,8 +298,11 @@ class Game(FSM.FSM):
 
 
     ## Level state
-    def enterLevel(self, level, difficulty, load_screen):
+    def enterLevel(self, level, difficulty, load_screen, retry=False):
         self.theme.stop()
+        if retry:
+            self.retry_level()
+            return
         self.ls = load_screen        
         
         #verifica se a cwiid esta instalada na maquina e se o controle escolhido eh envolve o Wiimote
@@ -245,30 +314,51 @@ class Game(FSM.FSM):
         else:
             self.level = Level(level, difficulty=difficulty, options=self.options)
         
-        Sequence(Func(self.ls.clear), SoundInterval(self.start_level_sfx), Func(self.level.setup), Func(self.level.play)).start()
+        Sequence(Func(self.ls.hide), SoundInterval(self.start_level_sfx), Func(self.level.setup), Func(self.level.play)).start()
         
+    #a fase terminada fica carregada enquanto o resultado eh mostrado, para a
+    #opcao de tentar de novo; destroy_level a descarta
     def exitLevel(self):
+        self.level_practice = False
         self.level_name = self.level.name
         self.level_score = self.level.score
-        self.rank_stats = (self.level.judgement_stats, self.level.n_rings)
-        del self.level
-        self.level = None
+        self.rank_stats = (dict(self.level.judgement_stats), self.level.n_rings)
         if uses_wii(self.options):
             self.wm.led = 0
+    
+    #recomeca a fase carregada, sem passar pela tela de carregamento
+    def retry_level(self):
+        if b_cwiid and uses_wii(self.options):
+            self.wm.led = cwiid.LED1_ON
+        self.level.reset()
+    
+    def destroy_level(self):
+        self.level.destroy()
+        self.level = None
 
     ## Result
     def enterResult(self):
         rank = self.calculate_rank(*self.rank_stats)
-        self.save_score(self.level_name, rank, self.level_score)
-        self.result_screen = ResultScreen(rank, self.level_score, self.rank_stats[0])
+        #resultados do treino (em outra velocidade) nao contam como recorde
+        if not self.level_practice:
+            self.save_score(self.level_name, rank, self.level_score)
+        self.result_screen = self.show_screen('Result', ResultScreen, rank, self.level_score, self.rank_stats[0])
         
     def exitResult(self):
-        self.result_screen.clear()
+        self.result_screen.hide()
 
     def filterResult(self, request, args):
+        if request == 'nav-left' or request == 'nav-right':
+            self.result_screen.option_changed(request)
         if request == 'nav-confirm':
+            if self.result_screen.option_pressed() == 'retry':
+                if self.level_practice:
+                    return ('Training', self.level_name, self.level.difficulty, None, self.level.rate, True)
+                return ('Level', self.level_name, self.level.difficulty, None, True)
+            self.destroy_level()
             return 'Title'
         if request == 'nav-back':
+            self.destroy_level()
             return 'Title'
 
     def enterExit(self):
@@ -421,32 +511,15 @@ class Controller(DirectObject.DirectObject):
     
 class JoystickManager:
     def __init__(self):
-        pygame.init()
-        pygame.joystick.init()
-        taskMgr.add(self.ctask_CheckEvents, "pygame-event")
-        
-        print("Joysticks available:", pygame.joystick.get_count())
-        
-        self.joy_list = [pygame.joystick.Joystick(i) for i in range(pygame.joystick.get_count())]
+        self.service = control.get_joystick_service()
         
-        if self.joy_list:
-            pass
+        print("Joysticks available:", self.service.get_count())
     
     def init_joy(self, id):
-        self.joy_list[id].init()
+        self.service.open(id)
     
     def set_current_joy(self, id):
         pass
-    
-    def ctask_CheckEvents(self, task):
-        pygame.event.pump()
-        
-        if self.joy.get_button(2): messenger.send("joy-button", ["A"])
-        if self.joy.get_button(1): messenger.send("joy-button", ["B"])
-        if self.joy.get_button(3): messenger.send("joy-button", ["C"])
-        if self.joy.get_button(0): messenger.send("joy-button", ["D"])
-            
-        return Task.cont
             
 
 if __name__ == '__main__':
@@ -455,20 +528,17 @@ if __name__ == '__main__':
     base.disableMouse()
     base.setBackgroundColor(.0, .0, .0, .0)
     
+    game = Game()
+    Controller(game)
+    
+    control.get_input_queue().set_table(control.compile_dispatch(game.options))
     control.KeyNavMapper()
     
     try:
-        pygame.init()
-        pygame.joystick.init()
-        j = pygame.joystick.Joystick(0)
-        j.init()
-        control.JoyNavMapper(j).activate()
+        control.JoyNavMapper(0).activate()
         
     except pygame.error as e:
         print(e)
     
-    game = Game()
-    Controller(game)
-    
     base.run()
     
\ No newline at end of file
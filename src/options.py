@@ -37,6 +37,19 @@ DEFAULTS = {
         
     'game-opts':{
             'controller': 'Keyboard',
+            'mouse-mode': 'relative',
+            'mouse-sensitivity': '0.004',
+            'hit-sounds': 'off',
+            'judgement-offset': '0.0',
+            'offset-visuals': 'off',
+            'practice-rate': '1.0',
+        },
+    
+    #preset: auto, low, medium, high ou ultra; os presets podem ser
+    #ajustados nas secoes [quality-<preset>] (ver quality.DEFAULT_PRESETS)
+    'quality':{
+            'preset': 'auto',
+            'target-fps': '60',
         }
 }
 
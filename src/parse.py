@@ -2,8 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import os
+from fractions import Fraction
 
-keywords = ["MUSIC_FILE", "TITLE", "BPM", "DIFFICULTIES", "ARTIST"]
+keywords = ["MUSIC_FILE", "TITLE", "BPM", "DIFFICULTIES", "ARTIST", "OFFSET", "TEMPO", "PREVIEW"]
+event_keywords = ["BANNER"]
+
+#primeira linha dos charts em que a coluna de tempo eh a batida absoluta do anel
+#(ex.: 16, 33.5 ou 67/3) em vez do intervalo desde o anel anterior
+CHART_V2 = "#!v2"
 
 class InvalidKeyword(Exception):
     pass
@@ -27,11 +33,13 @@ def level_header(name):
             
             if key not in keywords: 
                 raise InvalidKeyword("Invalid keyword '%s' found when parsing level %s at line %d" % (key, name, i))
-            if key == "BPM":
+            if key == "BPM" or key == "OFFSET" or key == "PREVIEW":
                 try:
                     value = float(value)
                 except ValueError:
                     raise ValueError("Error parsing line %d from file '%s': could not convert (%s) to float" % (i, level_file, value))
+            if key == "TEMPO":
+                value = parse_tempo(value, i, name)
             if key == "MUSIC_FILE":
                 value = os.path.join(LEVEL_DIR, name, value)            
             
@@ -44,27 +52,47 @@ def level_header(name):
     finally:
         level_file.close()
 
+#batidas sao lidas como fracoes exatas, para a soma dos intervalos nao acumular erro
+def parse_beat(beat_str):
+    return Fraction(beat_str.strip())
+
+#mudancas de andamento: "TEMPO=<batida>:<bpm>, <batida>:<bpm>, ..."
+def parse_tempo(value, i, name):
+    changes = []
+    for change in value.split(","):
+        try:
+            beat_str, bpm_str = change.split(":")
+            changes.append((parse_beat(beat_str), float(bpm_str)))
+        except ValueError:
+            raise ValueError("Error parsing line %d from header of level %s: could not convert (%s) to beat:bpm" % (i, name, change.strip()))
+    return changes
 
 def level_rings(levelname, diff):
     ring_list = []
-    time_ant = 0.0
+    time_ant = Fraction(0)
+    absolute = False
     ring_file = "%s.rng" % (diff)
     
     level_file = open(os.path.join(LEVEL_DIR, levelname, ring_file))
     try:
         for i, line in enumerate(level_file):
-            if line.strip() and not line.startswith('#'):
+            if i == 0 and line.strip() == CHART_V2:
+                absolute = True
+            elif line.strip() and not line.startswith('#') and not line.startswith('!'):
                 pos_str, time_str, button = line.split(";")
                 x, y = pos_str.split(",")
                 
                 try:
                     f_x, f_y = float(x), float(y)
                 except ValueError:
-                    raise ValueError("Error parsing line %d from file '%s': could not convert (%s, %s) to float tuple" % (i, level_addr, x, y))
+                    raise ValueError("Error parsing line %d from file '%s': could not convert (%s, %s) to float tuple" % (i, ring_file, x, y))
                 try:
-                    time_ant += float(time_str)
+                    if absolute:
+                        time_ant = parse_beat(time_str)
+                    else:
+                        time_ant += parse_beat(time_str)
                 except ValueError:
-                    raise ValueError("Error parsing line %d from file '%s': could not convert (%s) to float" % (i, level_addr, time_str))
+                    raise ValueError("Error parsing line %d from file '%s': could not convert (%s) to beat" % (i, ring_file, time_str))
                     
                 ring_list.append(((f_x, f_y), time_ant, button.strip()))           
             
@@ -73,4 +101,30 @@ def level_rings(levelname, diff):
     finally:
         level_file.close()
 
+#eventos do chart, em linhas "!<batida absoluta>; <EVENTO>; <argumento>"
+def level_events(levelname, diff):
+    event_list = []
+    ring_file = "%s.rng" % (diff)
+    
+    level_file = open(os.path.join(LEVEL_DIR, levelname, ring_file))
+    try:
+        for i, line in enumerate(level_file):
+            if line.startswith('!'):
+                beat_str, key, arg = line[1:].split(";", 2)
+                key = key.strip()
+                
+                if key not in event_keywords: 
+                    raise InvalidKeyword("Invalid event '%s' found when parsing level %s at line %d" % (key, levelname, i))
+                try:
+                    beat = parse_beat(beat_str)
+                except ValueError:
+                    raise ValueError("Error parsing line %d from file '%s': could not convert (%s) to beat" % (i, ring_file, beat_str))
+                
+                event_list.append((beat, key, arg.strip()))
+        
+        return event_list
+
+    finally:
+        level_file.close()
+
 #print level_list()
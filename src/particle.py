@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import heapq
+
+from direct.task import Task
 from direct.particles.ParticleEffect import ParticleEffect
 from direct.particles.Particles import Particles
 from direct.particles.ForceGroup import ForceGroup
@@ -10,6 +13,18 @@ from direct.interval.MetaInterval import Sequence
 from direct.interval.FunctionInterval import Func
 from direct.particles.ParticleEffect import ParticleEffect
 
+import quality
+
+#aplica os ajustes do governador de qualidade (quality.py) sobre os valores originais do efeito
+def apply_quality(effect, settings):
+    for p in effect.getParticlesList():
+        if not hasattr(p, 'base_birth_rate'):
+            p.base_birth_rate = p.getBirthRate()
+            p.base_pool_size = p.getPoolSize()
+        
+        p.setBirthRate(p.base_birth_rate * settings['particle-birth-scale'])
+        p.setPoolSize(min(p.base_pool_size, settings['particle-pool']))
+
 class BunnyParticles(ParticleEffect):
     def __init__(self):
         ParticleEffect.__init__(self)
@@ -130,3 +145,149 @@ class StarParticles(ParticleEffect):
         p0.emitter.setEndpoint1(Point3(-1.0000, 0.0000, 0.0000))
         p0.emitter.setEndpoint2(Point3(1.0000, 0.0000, 0.0000))
         self.addParticles(p0)
+
+#explosao curta de faiscas para acertos; nao nasce nada sozinho (taxa de
+#nascimento enorme), cada burst eh uma ninhada disparada com induceLabor
+class HitParticles(ParticleEffect):
+    LITTER_SIZE = 20
+    LIFESPAN = 0.6
+    
+    def __init__(self):
+        ParticleEffect.__init__(self)
+
+        self.reset()
+        self.setPos(0.000, 0.000, 0.000)
+        self.setHpr(0.000, 0.000, 0.000)
+        self.setScale(1.000, 1.000, 1.000)
+        p0 = Particles('particles-1')
+        # Particles parameters
+        p0.setFactory("PointParticleFactory")
+        p0.setRenderer("SpriteParticleRenderer")
+        p0.setEmitter("SphereVolumeEmitter")
+        p0.setPoolSize(2*self.LITTER_SIZE)
+        p0.setBirthRate(100000.0000)
+        p0.setLitterSize(self.LITTER_SIZE)
+        p0.setLitterSpread(0)
+        p0.setSystemLifespan(0.0000)
+        p0.setLocalVelocityFlag(1)
+        p0.setSystemGrowsOlderFlag(0)
+        # Factory parameters
+        p0.factory.setLifespanBase(self.LIFESPAN)
+        p0.factory.setLifespanSpread(0.0000)
+        p0.factory.setMassBase(1.0000)
+        p0.factory.setMassSpread(0.0000)
+        p0.factory.setTerminalVelocityBase(400.0000)
+        p0.factory.setTerminalVelocitySpread(0.0000)
+        # Point factory parameters
+        # Renderer parameters
+        p0.renderer.setAlphaMode(BaseParticleRenderer.PRALPHAOUT)
+        p0.renderer.setUserAlpha(1.00)
+        # Sprite parameters
+        p0.renderer.addTextureFromFile('./image/particle.png')
+        p0.renderer.setColor(Vec4(1.00, 1.00, 0.40, 1.00))
+        p0.renderer.setXScaleFlag(1)
+        p0.renderer.setYScaleFlag(1)
+        p0.renderer.setAnimAngleFlag(0)
+        p0.renderer.setInitialXScale(0.1000)
+        p0.renderer.setFinalXScale(0.0200)
+        p0.renderer.setInitialYScale(0.1000)
+        p0.renderer.setFinalYScale(0.0200)
+        p0.renderer.setNonanimatedTheta(0.0000)
+        p0.renderer.setAlphaBlendMethod(BaseParticleRenderer.PPBLENDLINEAR)
+        p0.renderer.setAlphaDisable(0)
+        # Emitter parameters
+        p0.emitter.setEmissionType(BaseParticleEmitter.ETRADIATE)
+        p0.emitter.setAmplitude(2.5000)
+        p0.emitter.setAmplitudeSpread(0.5000)
+        p0.emitter.setOffsetForce(Vec3(0.0000, 0.0000, 0.0000))
+        p0.emitter.setExplicitLaunchVector(Vec3(1.0000, 0.0000, 0.0000))
+        p0.emitter.setRadiateOrigin(Point3(0.0000, 0.0000, 0.0000))
+        # Sphere Volume parameters
+        p0.emitter.setRadius(0.1000)
+        self.addParticles(p0)
+    
+    def burst(self):
+        for p in self.getParticlesList():
+            p.induceLabor()
+
+#efeitos pre-alocados e reaproveitados. acquire/release para efeitos continuos
+#(estrelas do titulo), burst para explosoes curtas que voltam sozinhas ao pool;
+#o orcamento limita quantas particulas de burst podem estar vivas ao mesmo tempo
+class ParticleManager:
+    EFFECTS = {
+        'stars': (StarParticles, 1),
+        'hit': (HitParticles, 6),
+    }
+    
+    def __init__(self):
+        self.free = {}
+        self.effects = []
+        self.active = []
+        self.live_particles = 0
+        self.budget = 0
+        self.counter = 0
+        self.settings = None
+        
+        for name, (factory, count) in self.EFFECTS.items():
+            self.free[name] = [self.create(name) for i in range(count)]
+        
+        quality.get_governor().add_listener(self.apply_quality)
+        taskMgr.add(self.ctask_Reclaim, 'particle-reclaim')
+    
+    def create(self, name):
+        effect = self.EFFECTS[name][0]()
+        effect.pool_name = name
+        effect.cost = sum([p.getLitterSize() for p in effect.getParticlesList()])
+        self.effects.append(effect)
+        if self.settings:
+            apply_quality(effect, self.settings)
+        return effect
+    
+    def acquire(self, name):
+        if self.free[name]:
+            return self.free[name].pop()
+        return self.create(name)
+    
+    def release(self, effect):
+        effect.disable()
+        self.free[effect.pool_name].append(effect)
+    
+    #dispara um burst em pos (relativo a parent); sem efeito livre ou sem orcamento nao faz nada
+    def burst(self, name, parent, pos):
+        if not self.free[name]:
+            return None
+        effect = self.free[name][-1]
+        if self.live_particles + effect.cost > self.budget:
+            return None
+        
+        self.free[name].pop()
+        effect.start(parent)
+        effect.setPos(pos)
+        effect.burst()
+        
+        self.live_particles += effect.cost
+        self.counter += 1
+        heapq.heappush(self.active, (globalClock.getFrameTime() + effect.LIFESPAN, self.counter, effect))
+        return effect
+    
+    def ctask_Reclaim(self, task):
+        now = globalClock.getFrameTime()
+        while self.active and self.active[0][0] <= now:
+            expires, order, effect = heapq.heappop(self.active)
+            self.live_particles -= effect.cost
+            self.release(effect)
+        return Task.cont
+    
+    def apply_quality(self, settings):
+        self.settings = settings
+        self.budget = settings['particle-budget']
+        for effect in self.effects:
+            apply_quality(effect, settings)
+
+particle_manager = None
+
+def get_particle_manager():
+    global particle_manager
+    if particle_manager is None:
+        particle_manager = ParticleManager()
+    return particle_manager
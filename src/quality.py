@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+
+from direct.task import Task
+from panda3d.core import *
+
+QUALITY_LEVELS = ['low', 'medium', 'high', 'ultra']
+
+#particle-birth-scale multiplica o periodo entre nascimentos (maior = menos particulas)
+#particle-budget eh o maximo de particulas de burst (acertos) vivas ao mesmo tempo
+#ring-lookahead eh medido em batidas (0 = todos os aneis visiveis)
+DEFAULT_PRESETS = {
+    'low': {
+        'particle-birth-scale': 3.0,
+        'particle-pool': 128,
+        'particle-budget': 40,
+        'terrain-patches': 6,
+        'far': 300.0,
+        'fog-density': .008,
+        'ring-lookahead': 8,
+        'multisample': 0,
+    },
+    'medium': {
+        'particle-birth-scale': 2.0,
+        'particle-pool': 256,
+        'particle-budget': 80,
+        'terrain-patches': 10,
+        'far': 600.0,
+        'fog-density': .004,
+        'ring-lookahead': 16,
+        'multisample': 0,
+    },
+    'high': {
+        'particle-birth-scale': 1.5,
+        'particle-pool': 512,
+        'particle-budget': 160,
+        'terrain-patches': 14,
+        'far': 2000.0,
+        'fog-density': .002,
+        'ring-lookahead': 32,
+        'multisample': 1,
+    },
+    'ultra': {
+        'particle-birth-scale': 1.0,
+        'particle-pool': 1024,
+        'particle-budget': 320,
+        'terrain-patches': 20,
+        'far': 500000.0,
+        'fog-density': .002,
+        'ring-lookahead': 0,
+        'multisample': 1,
+    },
+}
+
+#presets padrao com os valores trocados nas secoes [quality-<nome>] do options.cfg
+def load_presets(options):
+    presets = {}
+    for name in QUALITY_LEVELS:
+        preset = dict(DEFAULT_PRESETS[name])
+        section = 'quality-%s' % name
+        if options.has_section(section):
+            for k, v in options.items(section):
+                if k in preset:
+                    preset[k] = type(preset[k])(float(v))
+        presets[name] = preset
+    return presets
+
+#o framebuffer multisample so pode ser pedido antes de a janela abrir; eh pedido
+#apenas quando o preset fixo escolhido usa multisample (no automatico a janela
+#abre sem ele, para nao pesar nas maquinas fracas que o governador protege)
+def request_multisample(options):
+    preset = options.get('quality', 'preset', fallback='auto')
+    if preset in QUALITY_LEVELS and load_presets(options)[preset]['multisample']:
+        loadPrcFileData('quality', 'framebuffer-multisample 1\nmultisamples 2')
+
+#controla a qualidade grafica a partir do tempo de frame (mediana da janela, para ignorar picos de carga)
+class QualityGovernor:
+    #tempo de frame acima de DOWN_RATIO*orcamento baixa a qualidade, abaixo de UP_RATIO*orcamento sobe
+    DOWN_RATIO = 1.15
+    UP_RATIO = 0.7
+
+    #tempo minimo (s) depois de qualquer mudanca antes de baixar/subir de novo
+    DOWN_HOLD = 2.0
+    UP_HOLD = 8.0
+
+    def __init__(self, options):
+        self.presets = load_presets(options)
+
+        preset = options.get('quality', 'preset', fallback='auto')
+        self.auto = preset not in QUALITY_LEVELS
+        if self.auto:
+            self.level = len(QUALITY_LEVELS) - 1
+        else:
+            self.level = QUALITY_LEVELS.index(preset)
+
+        self.frame_budget = 1.0/options.getfloat('quality', 'target-fps', fallback=60.0)
+        self.samples = collections.deque(maxlen=options.getint('quality', 'window', fallback=60))
+        self.next_down = 0.0
+        self.next_up = 0.0
+        self.listeners = []
+
+        self.apply_global()
+        taskMgr.add(self.ctask_Watch, 'quality-governor')
+
+    def settings(self):
+        return self.presets[QUALITY_LEVELS[self.level]]
+
+    #listener(settings) eh chamado ao registrar e a cada mudanca de nivel
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        listener(self.settings())
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def set_level(self, level):
+        self.level = level
+        self.apply_global()
+        for listener in list(self.listeners):
+            listener(self.settings())
+
+    def apply_global(self):
+        if self.settings()['multisample']:
+            render.setAntialias(AntialiasAttrib.MMultisample)
+        else:
+            render.setAntialias(AntialiasAttrib.MNone)
+
+    def ctask_Watch(self, task):
+        self.samples.append(globalClock.getDt())
+
+        if not self.auto or len(self.samples) < self.samples.maxlen:
+            return Task.cont
+
+        frame_time = sorted(self.samples)[len(self.samples)//2]
+
+        if frame_time > self.frame_budget*self.DOWN_RATIO:
+            if self.level > 0 and task.time >= self.next_down:
+                self.step(self.level - 1, task.time)
+        elif frame_time < self.frame_budget*self.UP_RATIO:
+            if self.level < len(QUALITY_LEVELS) - 1 and task.time >= self.next_up:
+                self.step(self.level + 1, task.time)
+
+        return Task.cont
+
+    def step(self, level, now):
+        self.set_level(level)
+        self.samples.clear()
+        self.next_down = now + self.DOWN_HOLD
+        self.next_up = now + self.UP_HOLD
+
+governor = None
+
+def get_governor(options=None):
+    global governor
+    if governor is None:
+        governor = QualityGovernor(options)
+    return governor
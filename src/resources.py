@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import collections
+
+from direct.task import Task
+from direct.gui.OnscreenImage import OnscreenImage
+from panda3d.core import *
+
+from build_atlas import ATLAS_IMAGE, ATLAS_INDEX, sprite_name
+from build_textures import cached_texture_path
+
+#texturas e RenderStates criados uma unica vez e compartilhados entre
+#nos, telas e reinicios de fase
+
+RING_COLORS = {
+    'A': (.4, .44, .81, 1),
+    'B': (1, .3, .3, 1),
+    'C': (.99, .0, 1, 1),
+    'D': (.39, 1, .62, 1),
+}
+
+THUMBNAIL_CACHE_DIR = './cache/thumbs'
+THUMBNAIL_WIDTH = 256
+
+textures = {}
+render_states = {}
+atlas_index = None
+thumbnail_loader = None
+
+#usa o .txo pre-processado por build_textures.py quando existe um para este arquivo
+def get_texture(path):
+    if path not in textures:
+        if os.path.exists(path) and os.path.exists(cached_texture_path(path)):
+            textures[path] = loader.loadTexture(cached_texture_path(path))
+        else:
+            textures[path] = loader.loadTexture(path)
+    return textures[path]
+
+#envmap esferico + cor do botao, um estado por botao
+def get_ring_state(button):
+    key = ('ring', button)
+    if key not in render_states:
+        render_states[key] = RenderState.make(
+            TextureAttrib.make(get_texture('./image/envmap.jpg')),
+            TexGenAttrib.make(TextureStage.getDefault(), TexGenAttrib.MEyeSphereMap),
+            ColorAttrib.makeFlat(VBase4(*RING_COLORS[button])))
+    return render_states[key]
+
+#textura + transparencia alpha, um estado por imagem
+def get_image_state(path):
+    key = ('image', path)
+    if key not in render_states:
+        render_states[key] = RenderState.make(
+            TextureAttrib.make(get_texture(path)),
+            TransparencyAttrib.make(TransparencyAttrib.MAlpha))
+    return render_states[key]
+
+def make_image(path, **kw):
+    image = OnscreenImage(image=get_texture(path), **kw)
+    image.setState(get_image_state(path))
+    return image
+
+#indice do atlas do HUD (gerado por build_atlas.py): nome -> (u0, v0, u1, v1)
+def get_atlas_index():
+    global atlas_index
+    if atlas_index is None:
+        atlas_index = {}
+        if os.path.exists(ATLAS_INDEX) and os.path.exists(ATLAS_IMAGE):
+            f = open(ATLAS_INDEX)
+            try:
+                for line in f:
+                    if line.strip():
+                        name, u0, v0, u1, v1 = line.strip().split(';')
+                        atlas_index[name] = (float(u0), float(v0), float(u1), float(v1))
+            finally:
+                f.close()
+    return atlas_index
+
+#imagem do HUD desenhada a partir do atlas; sem atlas, usa o arquivo avulso
+def make_sprite(path, **kw):
+    if sprite_name(path) not in get_atlas_index():
+        return make_image(path, **kw)
+    
+    image = make_image(ATLAS_IMAGE, **kw)
+    set_sprite(image, path)
+    return image
+
+#troca o sprite mudando so a transformacao de textura, sem trocar de textura
+def set_sprite(image, path):
+    uv = get_atlas_index().get(sprite_name(path))
+    if uv is None:
+        image.setTexture(get_texture(path), 1)
+        return
+    
+    u0, v0, u1, v1 = uv
+    image.setTexOffset(TextureStage.getDefault(), u0, v0)
+    image.setTexScale(TextureStage.getDefault(), u1 - u0, v1 - v0)
+
+#miniaturas reduzidas gravadas em THUMBNAIL_CACHE_DIR; criadas e lidas numa
+#thread propria, o callback eh chamado no thread principal pela task de entrega
+class ThumbnailLoader:
+    def __init__(self):
+        self.pending = collections.deque()
+        self.done = collections.deque()
+        self.cond = threading.Condition()
+        self.callbacks = {}
+        
+        self.thread = threading.Thread(target=self.run, name='thumbnail-loader')
+        self.thread.daemon = True
+        self.thread.start()
+        
+        taskMgr.add(self.ctask_Deliver, 'thumbnail-deliver')
+    
+    #callback(texture); pedidos repetidos do mesmo arquivo sao agrupados
+    def request(self, path, callback):
+        key = ('thumb', path)
+        if key in textures:
+            callback(textures[key])
+            return
+        
+        with self.cond:
+            if path in self.callbacks:
+                self.callbacks[path].append(callback)
+                return
+            self.callbacks[path] = [callback]
+            self.pending.append(path)
+            self.cond.notify()
+    
+    #descarta pedidos ainda nao atendidos (ex.: itens que sairam da tela)
+    def cancel(self, path, callback):
+        with self.cond:
+            if callback in self.callbacks.get(path, []):
+                self.callbacks[path].remove(callback)
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                path = self.pending.popleft()
+                if not self.callbacks.get(path):
+                    del self.callbacks[path]
+                    continue
+            
+            #qualquer erro vira uma miniatura vazia; o resultado eh sempre entregue,
+            #para o pedido nao ficar pendente
+            tex = None
+            try:
+                tex = Texture(path)
+                if not tex.read(Filename(thumbnail_path(path))):
+                    tex = None
+            except Exception as e:
+                print("Could not load thumbnail of '%s': %s" % (path, e))
+                tex = None
+            finally:
+                with self.cond:
+                    self.done.append((path, tex))
+    
+    def ctask_Deliver(self, task):
+        while self.done:
+            with self.cond:
+                path, tex = self.done.popleft()
+                callbacks = self.callbacks.pop(path, [])
+            
+            if tex is not None:
+                textures[('thumb', path)] = tex
+                for callback in callbacks:
+                    callback(tex)
+        
+        return Task.cont
+
+#gera (se preciso) a miniatura de path e devolve o caminho dela
+def thumbnail_path(path):
+    thumb = os.path.join(THUMBNAIL_CACHE_DIR, os.path.normpath(path).replace(os.sep, '_'))
+    if os.path.exists(thumb) and os.path.getmtime(thumb) >= os.path.getmtime(path):
+        return thumb
+    
+    src = PNMImage()
+    if not src.read(Filename(path)):
+        raise IOError("Could not read image '%s'" % path)
+    
+    w = min(THUMBNAIL_WIDTH, src.getXSize())
+    h = max(1, src.getYSize()*w//src.getXSize())
+    dst = PNMImage(w, h, src.getNumChannels(), src.getMaxval())
+    dst.quickFilterFrom(src)
+    
+    if not os.path.isdir(THUMBNAIL_CACHE_DIR):
+        os.makedirs(THUMBNAIL_CACHE_DIR)
+    
+    tmp = thumb + '.tmp.png'
+    if not dst.write(Filename(tmp)):
+        raise IOError("Could not write thumbnail '%s'" % thumb)
+    os.replace(tmp, thumb)
+    return thumb
+
+def get_thumbnail_loader():
+    global thumbnail_loader
+    if thumbnail_loader is None:
+        thumbnail_loader = ThumbnailLoader()
+    return thumbnail_loader
@@ -5,13 +5,24 @@ from direct.gui.OnscreenText import OnscreenText
 from direct.gui.OnscreenImage import OnscreenImage
 from direct.interval.IntervalGlobal import *
 from panda3d.core import *
+from direct.showbase import DirectObject
+from direct.task import Task
 
+import audio
 import parse
 import particle
+import resources
+from level import ButtonMap
+try:
+    import cwiid_compat as cwiid
+except ImportError:
+    try:
+        import cwiid
+    except ImportError:
+        pass
 from utils import *
 
 babelfish_font = None
-menuSfx = None
 
 def get_babelfish_font():
     global babelfish_font
@@ -19,26 +30,43 @@ def get_babelfish_font():
         babelfish_font = loader.loadFont('./fonts/hum.egg')
     return babelfish_font
 
-def get_menu_sfx():
-    global menuSfx
-    if menuSfx is None:
-        menuSfx = loader.loadSfx('./sound/menu.wav')
-    return menuSfx
+def play_menu_sfx():
+    audio.get_audio_cache().play_sfx('./sound/menu.wav')
 
-class TitleScreen:
+#base das telas de menu: os nos ficam sob uma raiz em render2d e outra em
+#aspect2d; a tela eh construida uma vez e so escondida/mostrada nas transicoes
+class Screen:
+    def __init__(self, name):
+        self.root2d = render2d.attachNewNode(name)
+        self.root = aspect2d.attachNewNode(name)
+        
+    def show(self):
+        self.root2d.show()
+        self.root.show()
+        
+    def hide(self):
+        self.root2d.hide()
+        self.root.hide()
+        
+    def clear(self):
+        self.root2d.removeNode()
+        self.root.removeNode()
+
+class TitleScreen(Screen):
     def __init__(self):
-        self.bg_particle = particle.StarParticles()
-        self.bg_particle.start(render2d)
+        Screen.__init__(self, 'TitleScreen')
+        
+        #efeito do pool do gerenciador de particulas (ja ajustado pelo governador de qualidade)
+        self.bg_particle = particle.get_particle_manager().acquire('stars')
+        self.bg_particle.start(self.root2d)
         self.bg_particle.setPos(.0, 1.5, 1.0)
         
         self.TITLE_SCALE = (512.0/base.win.getXSize(), 1 ,256.0/base.win.getYSize())
         
-        self.bg = OnscreenImage(image='./image/bg.png', pos = (0.0, 2.0, 0.0), parent=render2d)
-        self.bg.setTransparency(TransparencyAttrib.MAlpha)
+        self.bg = resources.make_image('./image/bg.png', pos = (0.0, 2.0, 0.0), parent=self.root2d)
         
         
-        self.title_img = OnscreenImage(image='./image/title.png', pos = (0.0, 1.0, 0.6), scale = self.TITLE_SCALE, parent=render2d)
-        self.title_img.setTransparency(TransparencyAttrib.MAlpha)
+        self.title_img = resources.make_image('./image/title.png', pos = (0.0, 1.0, 0.6), scale = self.TITLE_SCALE, parent=self.root2d)
         
         texts = [OnscreenText(text='Start', scale=0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1)),
             OnscreenText(text='Training',  scale=0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1)),
@@ -46,7 +74,7 @@ class TitleScreen:
             OnscreenText(text='Exit',  scale=0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))]
         
         for i in range(len(texts)):
-            node = aspect2d.attachNewNode("TextPos%d" % i)
+            node = self.root.attachNewNode("TextPos%d" % i)
             texts[i].reparentTo(node)
             node.setZ(-0.15*(i+1) - .08)
         
@@ -71,14 +99,27 @@ class TitleScreen:
             
         
         for opt in self.options:            
-            opt['sel_interval'] = Parallel(LerpScaleInterval(opt["node"], duration=0.2, startScale=1.0, scale=1.4, blendType='easeOut'), SoundInterval(get_menu_sfx()))
+            opt['sel_interval'] = Parallel(LerpScaleInterval(opt["node"], duration=0.2, startScale=1.0, scale=1.4, blendType='easeOut'), Func(play_menu_sfx))
             opt['des_interval'] = LerpScaleInterval(opt["node"], duration=0.2, startScale=1.4, scale=1.0, blendType='easeOut')
         
         self.curr_option = 0
-        self.options[self.curr_option]['sel_interval'].finish()
+        self.options[self.curr_option]['node'].setScale(1.4)
+        
+        self.copyright_text = OnscreenText(text='MoonBunny (c) TrombaSoft 2007', shadow=(.0,.0,.0,1), scale=0.09, pos=(.0, -.95), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)
         
-        self.copyright_text = OnscreenText(text='MoonBunny (c) TrombaSoft 2007', shadow=(.0,.0,.0,1), scale=0.09, pos=(.0, -.95), align=TextNode.ACenter, fg=(1,1,1,1))
+    def show(self):
+        Screen.show(self)
+        self.bg_particle.start(self.root2d)
+        
+        #volta para a primeira opcao, como numa tela nova
+        for opt in self.options:
+            opt['node'].setScale(1.0)
+        self.curr_option = 0
+        self.options[self.curr_option]['node'].setScale(1.4)
         
+    def hide(self):
+        Screen.hide(self)
+        self.bg_particle.disable()
     
     def option_changed(self, command):
         
@@ -95,59 +136,265 @@ class TitleScreen:
         
     def option_pressed(self):
         return self.options[self.curr_option]['action']
-                                                
+    
     def clear(self):
-        self.bg_particle.cleanup()
-        self.bg.destroy()
-        self.title_img.destroy()
-        for opt in self.options:
-            opt['node'].destroy()
-            
-        self.copyright_text.destroy()
+        particle.get_particle_manager().release(self.bg_particle)
+        Screen.clear(self)
 
 
-class LevelSelectScreen:
-    def __init__(self, game_opts):
+#item do carrossel de fases; os nos sao reaproveitados para outras fases ao rolar
+class LevelItem:
+    def __init__(self, parent):
+        self.node = parent.attachNewNode('LevelItem')
+        self.node.setZ(-0.1)
+        self.node.setScale(.8)
+        
+        cm = CardMaker('LevelImage')
+        cm.setFrame(-1, 1, -1, 1)
+        self.image = self.node.attachNewNode(cm.generate())
+        self.image.setScale(512.0/base.win.getXSize(), 1 ,362.0/base.win.getYSize())
+        self.image.setZ(0.3)
+        self.image.setTransparency(TransparencyAttrib.MAlpha)
+        
+        self.title_text = OnscreenText(text = '', pos = (0.0, 0.-0.3), scale = 0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.node, mayChange=True)
+        self.artist_text = OnscreenText(text = '', pos = (0.0, 0.-0.4), scale = 0.15, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.node, mayChange=True)
+        self.bpm_text = OnscreenText(text = '', pos = (0.0, -0.5), scale = 0.18, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.node, mayChange=True)
+        self.maxrank = OnscreenText(text = '', pos = (0.0, -0.65), scale = 0.18, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.node, mayChange=True)
+        self.hiscore = OnscreenText(text = '', pos = (0.0, -0.75), scale = 0.18, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.node, mayChange=True)
+        
+        self.index = None
+        self.image_path = None
+        
+    def bind(self, index, level_header, x):
+        self.unbind()
+        self.index = index
+        self.node.setX(x)
+        self.node.setScale(.8)
+        self.node.show()
+        
+        if "TITLE" in level_header:
+            self.title_text.setText("%s" % level_header["TITLE"])
+        else:
+            self.title_text.setText("%s" % level_header["NAME"])
+        
+        next_y = -0.50
+        if "ARTIST" in level_header:
+            next_y -= 0.05
+            self.artist_text.setText("by %s" %  level_header["ARTIST"])
+        else:
+            self.artist_text.setText("")
+        
+        self.bpm_text.setText("BPM %.2f" % level_header["BPM"])
+        self.bpm_text.setPos(0.0, next_y)
+        self.maxrank.setPos(0.0, next_y-0.15)
+        self.hiscore.setPos(0.0, next_y-0.25)
+        
+        #a miniatura chega depois; ate la o item fica sem imagem
+        self.image.hide()
+        self.image_path = './levels/%s/image.png' % level_header['NAME']
+        resources.get_thumbnail_loader().request(self.image_path, self.set_image)
+    
+    def set_image(self, tex):
+        self.image.setTexture(tex, 1)
+        self.image.show()
+    
+    def set_hiscore(self, his):
+        if his:
+            self.maxrank.setText("max rank %s" % his[0].upper())
+            self.hiscore.setText("hiscore %s" % his[1])
+        else:
+            self.maxrank.setText("")
+            self.hiscore.setText("")
+    
+    def unbind(self):
+        if self.image_path:
+            resources.get_thumbnail_loader().cancel(self.image_path, self.set_image)
+            self.image_path = None
+        self.index = None
+        self.node.hide()
+
+#carrossel virtualizado: so a fase atual e as vizinhas (ate VISIBLE_RADIUS) tem nos;
+#os cabecalhos sao lidos sob demanda
+class LevelSelectScreen(Screen):
+    VISIBLE_RADIUS = 2
+    #espera a selecao parar antes de pedir a previa, e duracao do cross-fade com o tema
+    PREVIEW_DELAY = 0.4
+    PREVIEW_FADE = 0.8
+    #velocidades do modo de treino
+    PRACTICE_RATES = [0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
+    
+    def __init__(self, game_opts, theme, practice=False):
+        Screen.__init__(self, 'LevelSelectScreen')
+        
         self.ITEM_SPACING = 1.7
         
         self.game_opts = game_opts
+        self.theme = theme
+        self.preview = None
+        self.preview_key = None
+        self.preview_interval = None
         
-        self.title = OnscreenText(text = 'Select Level', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
-        self.bg = OnscreenImage(image='./image/bg.png', pos = (0.0, -1.0, 0.0), parent=render2d)
-        self.bg.setTransparency(TransparencyAttrib.MAlpha)
+        self.title = OnscreenText(text = '', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
+        self.bg = resources.make_image('./image/bg.png', pos = (0.0, -1.0, 0.0), parent=self.root2d)
+        self.rate_txt = OnscreenText(text = '', pos = (0.0, -0.9), scale = 0.12, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
         
         self.curr_option = 0
-        self.levels = []
+        self.levels = parse.level_list()
+        self.levels.sort()
+        self.headers = {}
         
-        self.arrow_left =  OnscreenImage(image='./image/arrow_left.png', scale=(64.0/base.win.getXSize(), 1 ,64.0/base.win.getYSize()), pos = (-.8, -3.0, 0.0), parent=aspect2d)
-        self.arrow_left.setTransparency(TransparencyAttrib.MAlpha)
+        self.arrow_left = resources.make_sprite('./image/arrow_left.png', scale=(64.0/base.win.getXSize(), 1 ,64.0/base.win.getYSize()), pos = (-.8, -3.0, 0.0), parent=self.root)
         
-        self.arrow_right = OnscreenImage(image='./image/arrow_right.png', scale=(64.0/base.win.getXSize(), 1 ,64.0/base.win.getYSize()), pos = (.8, -3.0, 0.0), parent=aspect2d)
-        self.arrow_right.setTransparency(TransparencyAttrib.MAlpha)
+        self.arrow_right = resources.make_sprite('./image/arrow_right.png', scale=(64.0/base.win.getXSize(), 1 ,64.0/base.win.getYSize()), pos = (.8, -3.0, 0.0), parent=self.root)
         
-        level_list = parse.level_list()
-        level_list.sort()
-        
-        self.item_list_node = aspect2d.attachNewNode("ItemList")
+        self.item_list_node = self.root.attachNewNode("ItemList")
         self.initial_x = self.item_list_node.getX()
         
-        for i, lvl in enumerate(level_list):
-            header = parse.level_header(lvl)
-            
-            level_item = self.make_level_item(header)
-            level_item.setX(self.ITEM_SPACING*i)
-            level_item.setZ(-0.1)
-            level_item.setScale(.8)
-            
-            level_item.reparentTo(self.item_list_node)
-            self.levels.append(header['NAME'])
-    
+        self.items = [LevelItem(self.item_list_node) for i in range(2*self.VISIBLE_RADIUS + 1)]
+        
         self.cur_interval = None
+        self.set_practice(practice)
+        self.update()
+        
+    def show(self, practice=False):
+        Screen.show(self)
+        self.set_practice(practice)
+        #forca reler os recordes dos itens visiveis
+        for item in self.items:
+            item.unbind()
         self.update()
+        
+    def hide(self):
+        Screen.hide(self)
+        if self.cur_interval:
+            self.cur_interval.finish()
+            self.cur_interval = None
+        
+        self.cancel_preview()
+        if self.preview_interval:
+            self.preview_interval.finish()
+        self.theme.setVolume(1)
+    
+    #previa da musica selecionada: pedida quando a selecao para por PREVIEW_DELAY
+    #segundos e tocada em cross-fade com o tema, voltando ao tema no fim do trecho
+    def change_preview(self):
+        self.cancel_preview()
+        self.fade_out_preview()
+        taskMgr.doMethodLater(self.PREVIEW_DELAY, self.request_preview, 'preview-settle')
+    
+    def request_preview(self, task):
+        header = self.get_header(self.curr_option)
+        self.preview_key = (header["MUSIC_FILE"], header.get("PREVIEW"))
+        audio.get_preview_loader().request(self.preview_key[0], self.preview_key[1], self.play_preview)
+        return Task.done
+    
+    def cancel_preview(self):
+        taskMgr.remove('preview-settle')
+        if self.preview_key:
+            audio.get_preview_loader().cancel(self.preview_key[0], self.preview_key[1], self.play_preview)
+            self.preview_key = None
+    
+    def set_mix(self, volume, preview):
+        preview.setVolume(volume)
+        self.theme.setVolume(1 - volume)
+    
+    def play_preview(self, preview):
+        self.preview_key = None
+        #termina de uma vez o fade da previa anterior
+        if self.preview_interval:
+            self.preview_interval.finish()
+        
+        self.preview = preview
+        preview.setVolume(0)
+        preview.play()
+        
+        fade = self.PREVIEW_FADE
+        self.preview_interval = Sequence(LerpFunc(self.set_mix, fromData=0, toData=1, duration=fade, extraArgs=[preview]),
+                                         Wait(max(preview.length() - 2*fade, 0)),
+                                         LerpFunc(self.set_mix, fromData=1, toData=0, duration=fade, extraArgs=[preview]),
+                                         Func(self.stop_preview, preview))
+        self.preview_interval.start()
+    
+    #volta ao tema a partir do volume atual da previa
+    def fade_out_preview(self):
+        if self.preview_interval:
+            self.preview_interval.pause()
+            self.preview_interval = None
+        if self.preview:
+            preview = self.preview
+            self.preview_interval = Sequence(LerpFunc(self.set_mix, fromData=preview.getVolume(), toData=0, duration=self.PREVIEW_FADE, extraArgs=[preview]),
+                                             Func(self.stop_preview, preview))
+            self.preview_interval.start()
+    
+    def stop_preview(self, preview):
+        preview.stop()
+        if self.preview is preview:
+            self.preview = None
+            self.preview_interval = None
+    
+    #no treino a tela tambem escolhe a velocidade (nav-up/nav-down)
+    def set_practice(self, practice):
+        self.practice = practice
+        if practice:
+            self.title.setText('Practice')
+            rate = self.game_opts.getfloat('game-opts', 'practice-rate', fallback=1.0)
+            self.curr_rate = min(range(len(self.PRACTICE_RATES)), key=lambda i: abs(self.PRACTICE_RATES[i] - rate))
+            self.update_rate()
+            self.rate_txt.show()
+        else:
+            self.title.setText('Select Level')
+            self.rate_txt.hide()
+    
+    def update_rate(self):
+        self.rate_txt.setText('speed %d%%' % round(self.selected_rate()*100))
+    
+    def rate_changed(self, command):
+        if command == 'up' and self.curr_rate < len(self.PRACTICE_RATES) - 1:
+            self.curr_rate += 1
+        elif command == 'down' and self.curr_rate > 0:
+            self.curr_rate -= 1
+        else:
+            return
+        self.game_opts.set('game-opts', 'practice-rate', str(self.selected_rate()))
+        self.update_rate()
+        play_menu_sfx()
+    
+    def selected_rate(self):
+        return self.PRACTICE_RATES[self.curr_rate]
+    
+    def get_header(self, index):
+        name = self.levels[index]
+        if name not in self.headers:
+            self.headers[name] = parse.level_header(name)
+        return self.headers[name]
+    
+    def get_hiscore(self, level_name):
+        if self.game_opts.has_option('hiscores', level_name):
+            return self.game_opts.get('hiscores', level_name).split(',')
+        return None
+    
+    #associa cada fase dentro do raio visivel a um item (indice % numero de itens)
+    def bind_items(self):
+        first = max(0, self.curr_option - self.VISIBLE_RADIUS)
+        last = min(len(self.levels) - 1, self.curr_option + self.VISIBLE_RADIUS)
+        
+        for item in self.items:
+            if item.index is not None and not (first <= item.index <= last):
+                item.unbind()
+        
+        for index in range(first, last + 1):
+            item = self.items[index % len(self.items)]
+            if item.index != index:
+                header = self.get_header(index)
+                item.bind(index, header, self.ITEM_SPACING*index)
+                item.set_hiscore(self.get_hiscore(header['NAME']))
+    
+    def current_item(self):
+        return self.items[self.curr_option % len(self.items)]
     
     def create_cur_interval(self):
-        return Sequence(LerpScaleInterval(self.item_list_node.getChild(self.curr_option), duration=0.4, startScale=.8, scale=.85), 
-                                    LerpScaleInterval(self.item_list_node.getChild(self.curr_option), duration=0.4, startScale=.85, scale=.8))
+        return Sequence(LerpScaleInterval(self.current_item().node, duration=0.4, startScale=.8, scale=.85), 
+                                    LerpScaleInterval(self.current_item().node, duration=0.4, startScale=.85, scale=.8))
     
     def option_changed(self, command):
         changed = False
@@ -161,7 +408,7 @@ class LevelSelectScreen:
             changed = True
         
         if changed:
-            interval = Parallel(LerpPosInterval(self.item_list_node, duration=.2, startPos=VBase3(self.item_list_node.getX(),.0,.0), pos=VBase3(-self.ITEM_SPACING*self.curr_option,.0,.0)), SoundInterval(get_menu_sfx()))
+            interval = Parallel(LerpPosInterval(self.item_list_node, duration=.2, startPos=VBase3(self.item_list_node.getX(),.0,.0), pos=VBase3(-self.ITEM_SPACING*self.curr_option,.0,.0)), Func(play_menu_sfx))
             interval.start()
             self.update()
     
@@ -180,92 +427,87 @@ class LevelSelectScreen:
             self.cur_interval.finish()
             del self.cur_interval
         
+        self.bind_items()
+        
         self.cur_interval = self.create_cur_interval()
         self.cur_interval.loop()
+        
+        self.change_preview()
     
     def option_pressed(self):
         return self.levels[self.curr_option]
                                                 
     def clear(self):
-        self.bg.destroy()
-        self.arrow_left.destroy()
-        self.arrow_right.destroy()
-        self.title.destroy()
-        self.item_list_node.removeNode()
-            
-    def make_level_item(self, level_header):
-        level_name = level_header['NAME']
-        
-        level_item = aspect2d.attachNewNode(level_name)
-        level_img = OnscreenImage(image='./levels/%s/image.png' % level_name, 
-                scale=(512.0/base.win.getXSize(), 1 ,362.0/base.win.getYSize()), pos = (0.0, 0.0, 0.3), parent=level_item)
-                
-        level_img.setTransparency(TransparencyAttrib.MAlpha)
-        level_img.reparentTo(level_item)
-        
-        if "TITLE" in level_header:
-            title_str = "%s" % level_header["TITLE"]
-        else:
-            title_str = "%s" % level_header["NAME"]
-        
-        artist_str = ""
-        if "ARTIST" in level_header:
-            artist_str = "by %s" %  level_header["ARTIST"]
-            
-        
-        title_text = OnscreenText(text = title_str, pos = (0.0, 0.-0.3), scale = 0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
-        title_text.reparentTo(level_item)
-        
-        next_y = -0.50
+        self.hide()
+        for item in self.items:
+            item.unbind()
+        Screen.clear(self)
+
+class OptionsScreen(Screen):
+    def __init__(self, options):
+        Screen.__init__(self, 'OptionsScreen')
         
-        if artist_str:
-            next_y -= 0.05
-            artist_text = OnscreenText(text = artist_str, pos = (0.0, 0.-0.4), scale = 0.15, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
-            artist_text.reparentTo(level_item)
-            
-            
-        bpm_text = OnscreenText(text = "BPM %.2f" % level_header["BPM"], pos = (0.0, next_y), scale = 0.18, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
-        bpm_text.reparentTo(level_item)
+        self.bg = resources.make_image('./image/bg.png', pos = (0.0, -1.0, 0.0), parent=self.root2d)
         
-        if self.game_opts.has_option('hiscores', level_name):
-            his = self.game_opts.get('hiscores', level_name).split(',')            
-            maxrank = OnscreenText(text = "max rank %s" % his[0].upper(), 
-                pos = (0.0, next_y-0.15), scale = 0.18, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
-                
-            hiscore = OnscreenText(text = "hiscore %s" % his[1], 
-                pos = (0.0, next_y-0.25), scale = 0.18, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
+        self.title = OnscreenText(text = 'Options', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)
 
-            maxrank.reparentTo(level_item)
-            hiscore.reparentTo(level_item)
+        self.option_title_txt = OnscreenText(text='Controller', scale=0.2, pos=(-1.0, 0.0), font=get_babelfish_font(), align=TextNode.ALeft, fg=(1,1,1,1), parent=self.root)
         
-        return level_item
-
-class OptionsScreen:
-    def __init__(self, options):
-        self.bg = OnscreenImage(image='./image/bg.png', pos = (0.0, -1.0, 0.0), parent=render2d)
-        self.bg.setTransparency(TransparencyAttrib.MAlpha)
+        self.option_value_txt = OnscreenText(text='', scale=0.2, pos=(.7, 0.0), font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
         
-        self.title = OnscreenText(text = 'Options', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
-
-        self.option_title_txt = OnscreenText(text='Controller', scale=0.2, pos=(-1.0, 0.0), font=get_babelfish_font(), align=TextNode.ALeft, fg=(1,1,1,1))
+        self.calibrate_title_txt = OnscreenText(text='Calibrate', scale=0.2, pos=(-1.0, -0.3), font=get_babelfish_font(), align=TextNode.ALeft, fg=(1,1,1,1), parent=self.root)
         
-        self.option_value = options.get('game-opts', 'controller')
-        self.option_value_txt = OnscreenText(text=self.option_value, scale=0.2, pos=(.7, 0.0), font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
+        self.calibrate_value_txt = OnscreenText(text='', scale=0.2, pos=(.7, -0.3), font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
     
         self.options = options
-        self.curr_controller = 0
         
         self.controllers = ['Keyboard','Joypad', 'Mouse']
         
+        self.rows = [('controller', self.option_title_txt), ('calibrate', self.calibrate_title_txt)]
+        
+        self.show()
+        
+    def show(self):
+        Screen.show(self)
+        
         #define o controle atual baseado no arquivo salvo
+        self.option_value = self.options.get('game-opts', 'controller')
+        self.curr_controller = 0
         for f in self.controllers:
             if f == self.option_value:
                 break
             else:
                 self.curr_controller += 1
         
+        self.option_value_txt.setText(self.option_value)
+        
+        offset = self.options.getfloat('game-opts', 'judgement-offset', fallback=0.0)
+        self.calibrate_value_txt.setText("%+d ms" % round(offset*1000))
+        
+        self.curr_row = 0
+        self.update_rows()
+    
+    def update_rows(self):
+        for i, (name, txt) in enumerate(self.rows):
+            if i == self.curr_row:
+                txt.setScale(1.2)
+            else:
+                txt.setScale(1.0)
+    
+    def row_changed(self, command):
+        if command == 'nav-up':
+            self.curr_row = (self.curr_row - 1) % len(self.rows)
+        elif command == 'nav-down':
+            self.curr_row = (self.curr_row + 1) % len(self.rows)
+        self.update_rows()
+        play_menu_sfx()
+    
+    def selected_row(self):
+        return self.rows[self.curr_row][0]
+        
     def option_changed(self, command):
-        self.toggle_value(command)
+        if self.selected_row() == 'controller':
+            self.toggle_value(command)
     
     def toggle_value(self, opt):
         if opt == 'nav-right':
@@ -278,71 +520,218 @@ class OptionsScreen:
             self.curr_controller = len(self.controllers) - 1
             
         self.option_value = self.controllers[self.curr_controller]
-        self.option_value_txt.destroy()
-        self.option_value_txt = OnscreenText(text=self.option_value, scale=0.2, pos=(.7, 0.0), font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))
+        self.option_value_txt.setText(self.option_value)
+    
+    #grava o valor escolhido nas opcoes (quem chama eh responsavel por salvar o arquivo)
+    def apply(self):
+        self.options.set('game-opts', 'controller', self.option_value)
     
     def clear(self):
-        self.bg.destroy()
-        self.title.destroy()
-        
-        self.option_title_txt.destroy()
-        self.option_value_txt.destroy()
+        self.apply()
+        Screen.clear(self)
 
-        self.options.set('game-opts', 'controller', self.option_value)
+#metronomo para medir a latencia de audio: o jogador aperta um botao de jogo a
+#cada clique e o atraso mediano (sem outliers) vira o judgement-offset
+class CalibrationScreen(Screen, DirectObject.DirectObject):
+    CLICK_PERIOD = 0.6
+    N_CLICKS = 20
+    WARMUP_CLICKS = 4
+    MIN_TAPS = 8
+    CLICK_SOUND = './sound/menu.wav'
+    
+    #wm: Wiimote conectado quando o controle escolhido usa o Wiimote
+    def __init__(self, options, wm=None):
+        Screen.__init__(self, 'CalibrationScreen')
+        
+        self.options = options
+        self.button_map = None
+        
+        self.bg = resources.make_image('./image/bg.png', pos = (0.0, -1.0, 0.0), parent=self.root2d)
+        
+        self.title = OnscreenText(text = 'Calibration', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)
+        self.info_txt = OnscreenText(text = 'Press any game button on every click', pos = (0.0, 0.35), scale = 0.1, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)
+        self.status_txt = OnscreenText(text = '', pos = (0.0, -0.1), scale = 0.25, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
+        self.help_txt = OnscreenText(text = '', shadow=(.0,.0,.0,1), scale=0.09, pos=(.0, -.95), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
+        
+        self.show(wm)
+    
+    def show(self, wm=None):
+        self.wm = wm
+        Screen.show(self)
+        self.start()
+    
+    def hide(self):
+        Screen.hide(self)
+        self.stop()
+    
+    def start(self):
+        self.stop()
+        self.taps = []
+        self.clicks = []
+        self.result = None
+        self.finished = False
+        self.first_click = globalClock.getRealTime() + 1.0
+        
+        self.status_txt.setText('')
+        self.help_txt.setText('ESC to cancel')
+        
+        #joypad e Wiimote sao lidos pelo ButtonMap, como na fase
+        if self.wm is not None:
+            b_nunc = uses_nunchuk(self.options) and self.wm.wait_extension(timeout=0.5) != cwiid.EXT_NUNCHUK
+            self.button_map = ButtonMap(self.options, wm=self.wm, b_nunc=b_nunc)
+        else:
+            self.button_map = ButtonMap(self.options)
+        
+        for event in ['key-button', 'joy-button', 'wii-button', 'nunchuk-button']:
+            self.accept(event, self.tap)
+        taskMgr.add(self.ctask_Metronome, 'calibration-metronome')
+    
+    def stop(self):
+        taskMgr.remove('calibration-metronome')
+        if self.button_map is not None:
+            self.button_map.cleanup()
+            self.button_map = None
+        self.ignoreAll()
+    
+    #o instante de referencia eh o do play() de fato, nao o agendado
+    def ctask_Metronome(self, task):
+        now = globalClock.getRealTime()
+        
+        if len(self.clicks) < self.N_CLICKS:
+            if now >= self.first_click + len(self.clicks)*self.CLICK_PERIOD:
+                audio.get_audio_cache().play_sfx(self.CLICK_SOUND)
+                self.clicks.append(now)
+                self.status_txt.setText("%d" % (self.N_CLICKS - len(self.clicks)))
+        elif now >= self.clicks[-1] + self.CLICK_PERIOD:
+            self.finish()
+            return Task.done
+        
+        return Task.cont
+    
+    def tap(self, button, stamp=None):
+        if stamp is None:
+            stamp = globalClock.getRealTime()
+        if not self.clicks:
+            return
+        
+        n = min(range(len(self.clicks)), key=lambda i: abs(stamp - self.clicks[i]))
+        if n >= self.WARMUP_CLICKS and abs(stamp - self.clicks[n]) < self.CLICK_PERIOD/2:
+            self.taps.append(stamp - self.clicks[n])
+    
+    def finish(self):
+        self.stop()
+        self.finished = True
+        
+        if len(self.taps) >= self.MIN_TAPS:
+            self.result = robust_offset(self.taps)
+            self.status_txt.setText("%+d ms" % round(self.result*1000))
+            self.help_txt.setText('SPACE to save, ESC to cancel')
+        else:
+            self.status_txt.setText('Not enough taps')
+            self.help_txt.setText('SPACE to try again, ESC to cancel')
+    
+    #grava o offset medido nas opcoes (quem chama eh responsavel por salvar o arquivo)
+    def apply(self):
+        self.options.set('game-opts', 'judgement-offset', '%.3f' % self.result)
+    
+    def clear(self):
+        self.stop()
+        Screen.clear(self)
 
-class ResultScreen:
+class ResultScreen(Screen):
+    JUDGEMENTS = ["PERFECT","GOOD","OK","BAD","MISS"]
+    
     def __init__(self, rank, score, stats):        
-        text_list = []
-        
-        text_list.append(OnscreenText(text = 'Level Ended', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1)))
+        Screen.__init__(self, 'ResultScreen')
         
-        judgements = ["PERFECT","GOOD","OK","BAD","MISS"]
+        OnscreenText(text = 'Level Ended', pos = (0.0, 0.7), scale = 0.3, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)
         
-        text_j = "\n".join(judgements)
-       
-        text_n = "\n".join(["%d" % stats[j] for j in judgements])
+        text_j = "\n".join(self.JUDGEMENTS)
         
-        text_list.append(OnscreenText(text = text_j, pos = (-1.2, 0.35), scale = 0.2, font=get_babelfish_font(), align=TextNode.ALeft, fg=(1,1,1,1)))
-        text_list.append(OnscreenText(text = text_n, pos = (0.2, 0.35), scale = 0.2, font=get_babelfish_font(), align=TextNode.ARight, fg=(1,1,1,1)))
-        text_list.append((OnscreenText(text = "RANK", pos = (0.85, 0.35), scale = 0.15, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))))
+        OnscreenText(text = text_j, pos = (-1.2, 0.35), scale = 0.2, font=get_babelfish_font(), align=TextNode.ALeft, fg=(1,1,1,1), parent=self.root)
+        self.stats_text = OnscreenText(text = '', pos = (0.2, 0.35), scale = 0.2, font=get_babelfish_font(), align=TextNode.ARight, fg=(1,1,1,1), parent=self.root, mayChange=True)
+        OnscreenText(text = "RANK", pos = (0.85, 0.35), scale = 0.15, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)
         
-        self.rank_image = OnscreenImage(image = "./image/rank_%s.png" % rank, pos = (0.7, 0.0, -0.2), 
-                scale = (256.0/base.win.getXSize()*0.8, 1.0, 256.0/base.win.getYSize()*0.8), parent=render2d)
-        self.rank_image.setTransparency(TransparencyAttrib.MAlpha)
+        self.rank_image = resources.make_sprite("./image/rank_%s.png" % rank, pos = (0.7, 0.0, -0.2), 
+                scale = (256.0/base.win.getXSize()*0.8, 1.0, 256.0/base.win.getYSize()*0.8), parent=self.root2d)
         
         #text_list.append((OnscreenText(text = rank, pos = (0.75, -0.25), scale = 0.9, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))))
         
-        text_list.append((OnscreenText(text = 'SCORE   %d'%score, pos = (0.0, -0.7), scale = 0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))))
-        text_list.append((OnscreenText(text = 'press "SPACE " to continue', pos = (0.0, -0.9), scale = 0.16, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1))))
+        self.score_text = OnscreenText(text = '', pos = (0.0, -0.7), scale = 0.2, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
+        
+        #continuar (volta ao titulo) ou tentar de novo a mesma fase, com nav-left/nav-right
+        self.options = [
+            ('continue', OnscreenText(text = 'Continue', pos = (-0.4, -0.9), scale = 0.16, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)),
+            ('retry', OnscreenText(text = 'Retry', pos = (0.4, -0.9), scale = 0.16, font=get_babelfish_font(), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root)),
+        ]
+        
+        self.show(rank, score, stats)
         
-        self.text_list = text_list
+    def show(self, rank, score, stats):
+        Screen.show(self)
         
-    def clear(self):
-        self.rank_image.destroy()
+        self.stats_text.setText("\n".join(["%d" % stats[j] for j in self.JUDGEMENTS]))
+        resources.set_sprite(self.rank_image, "./image/rank_%s.png" % rank)
+        self.score_text.setText('SCORE   %d'%score)
         
-        for txt in self.text_list:
-            txt.destroy()
+        self.curr_option = 0
+        self.update_options()
+    
+    def update_options(self):
+        for i, (action, txt) in enumerate(self.options):
+            if i == self.curr_option:
+                txt.setScale(1.3)
+            else:
+                txt.setScale(1.0)
+    
+    def option_changed(self, command):
+        if command == 'nav-left':
+            self.curr_option = (self.curr_option - 1) % len(self.options)
+        elif command == 'nav-right':
+            self.curr_option = (self.curr_option + 1) % len(self.options)
+        self.update_options()
+        play_menu_sfx()
+    
+    def option_pressed(self):
+        return self.options[self.curr_option][0]
 
-class LoadScreen:
+class LoadScreen(Screen):
+    BACKGROUNDS = {
+        'Joypad': './image/tela_joypad.png',
+        'Keyboard': './image/tela_keyboard.png',
+        'Mouse': './image/tela_mouse.png',
+    }
+    
     def __init__(self, options):        
-        self.options = options
+        Screen.__init__(self, 'LoadScreen')
         
-        if self.options.get('game-opts', 'controller') == 'Joypad':
-            self.bg = OnscreenImage(image='./image/tela_joypad.png', pos = (0.0, 2.0, 0.0), parent=render2d)
-            self.bg.setTransparency(TransparencyAttrib.MAlpha)
-        elif self.options.get('game-opts', 'controller') == 'Keyboard':
-            self.bg = OnscreenImage(image='./image/tela_keyboard.png', pos = (0.0, 2.0, 0.0), parent=render2d)
-            self.bg.setTransparency(TransparencyAttrib.MAlpha)
-        elif self.options.get('game-opts', 'controller') == 'Mouse':
-            self.bg = OnscreenImage(image='./image/tela_mouse.png', pos = (0.0, 2.0, 0.0), parent=render2d)
-            self.bg.setTransparency(TransparencyAttrib.MAlpha)
+        self.options = options
+        #um fundo por controle, criados uma vez; show so mostra o do controle atual
+        self.backgrounds = {}
+        for controller, path in self.BACKGROUNDS.items():
+            self.backgrounds[controller] = resources.make_image(path, pos = (0.0, 2.0, 0.0), parent=self.root2d)
+            self.backgrounds[controller].hide()
+        self.bg = None
+        self.press = OnscreenText(text='', shadow=(.0,.0,.0,1), scale=0.09, pos=(.0, -.95), align=TextNode.ACenter, fg=(1,1,1,1), parent=self.root, mayChange=True)
+        
+        self.show()
+        
+    def show(self):
+        Screen.show(self)
+        
+        if self.bg:
+            self.bg.hide()
+        self.bg = self.backgrounds.get(self.options.get('game-opts', 'controller'))
+        if self.bg:
+            #alpha() deixa o fundo transparente ao sair
+            self.bg.setAlphaScale(1)
+            self.bg.show()
 
         if uses_wii(self.options):
-            self.press =  self.wiimote_connection_text = OnscreenText(text='Press SPACE to continue and 1+2 to connect the Wiimote', shadow=(.0,.0,.0,1), scale=0.09, pos=(.0, -.95), align=TextNode.ACenter, fg=(1,1,1,1))
+            self.press.setText('Press SPACE to continue and 1+2 to connect the Wiimote')
         else:
-            self.press =  self.wiimote_connection_text = OnscreenText(text='Press SPACE to continue', shadow=(.0,.0,.0,1), scale=0.09, pos=(.0, -.95), align=TextNode.ACenter, fg=(1,1,1,1))
+            self.press.setText('Press SPACE to continue')
+            
     def alpha(self):
-        Sequence(LerpFunc(self.bg.setAlphaScale, fromData=.1, toData=0, duration=.3)).start()
-    def clear(self):
-        self.bg.destroy()
-        self.press.destroy()
+        if self.bg:
+            Sequence(LerpFunc(self.bg.setAlphaScale, fromData=.1, toData=0, duration=.3)).start()
@@ -1,12 +1,44 @@
 ﻿#!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import heapq
+from bisect import bisect_right
+
 def time2pos(time, delay_per_beat, space_per_beat):
     return (time / delay_per_beat) * space_per_beat
     
 def beat_delay(bpm):
     return 60.0/bpm
     
+#mapa de andamento: BPM inicial mais mudancas (batida, bpm) ordenadas, com o
+#instante de inicio de cada trecho pre-calculado; as conversoes batida <->
+#segundos <-> posicao sao uma busca binaria nos trechos, sem acumular erro
+class TempoMap:
+    def __init__(self, bpm, changes=()):
+        self.beats = [0]
+        self.delays = [beat_delay(bpm)]
+        for beat, change_bpm in sorted(changes):
+            if beat == self.beats[-1]:
+                self.delays[-1] = beat_delay(change_bpm)
+            else:
+                self.beats.append(beat)
+                self.delays.append(beat_delay(change_bpm))
+        
+        self.times = [0.0]
+        for i in range(1, len(self.beats)):
+            self.times.append(self.times[-1] + float(self.beats[i] - self.beats[i - 1])*self.delays[i - 1])
+    
+    def beat2time(self, beat):
+        i = max(bisect_right(self.beats, beat) - 1, 0)
+        return self.times[i] + float(beat - self.beats[i])*self.delays[i]
+    
+    def time2beat(self, time):
+        i = max(bisect_right(self.times, time) - 1, 0)
+        return float(self.beats[i]) + (time - self.times[i])/self.delays[i]
+    
+    def time2pos(self, time, space_per_beat):
+        return self.time2beat(time)*space_per_beat
+    
 def clamp(low, v, hi): return max(low, min(v, hi))
     
 def norm(acc, cal):
@@ -15,6 +47,58 @@ def norm(acc, cal):
 def desloc(graus):
     return graus/100000.0
     
+#agenda de acoes pelo tempo da musica: um heap de (tempo, ordem, callback, args)
+#que eh disparado por update(tempo_da_musica), sem tasks proprias
+class SongScheduler:
+    def __init__(self, tempo):
+        self.tempo = tempo
+        self.heap = []
+        self.counter = 0
+        self.now = 0.0
+    
+    def at(self, time, callback, *args):
+        self.counter += 1
+        heapq.heappush(self.heap, (time, self.counter, callback, args))
+    
+    def at_beat(self, beat, callback, *args):
+        self.at(self.tempo.beat2time(beat), callback, *args)
+    
+    #relativo ao ultimo update
+    def after(self, delay, callback, *args):
+        self.at(self.now + delay, callback, *args)
+    
+    def after_beats(self, beats, callback, *args):
+        self.at(self.tempo.beat2time(self.tempo.time2beat(self.now) + beats), callback, *args)
+    
+    def update(self, time):
+        self.now = time
+        while self.heap and self.heap[0][0] <= time:
+            event_time, order, callback, args = heapq.heappop(self.heap)
+            callback(*args)
+    
+    def clear(self):
+        self.heap = []
+    
+    #esvazia a agenda e passa a contar a partir de time (ex.: depois de um seek)
+    def reset(self, time):
+        self.clear()
+        self.now = time
+    
+#mediana com rejeicao de outliers: descarta amostras a mais de 3 desvios
+#absolutos medianos (minimo de 20 ms) da mediana e tira a mediana do resto
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n//2]
+    return (values[n//2 - 1] + values[n//2])/2.0
+
+def robust_offset(samples, min_spread=0.02):
+    m = median(samples)
+    spread = max(3*median([abs(s - m) for s in samples]), min_spread)
+    kept = [s for s in samples if abs(s - m) <= spread]
+    return median(kept)
+    
 class ListMovements:
     #map: 0 - fly, 1 = left, 2 = right, 3 = up, 4 = down 
     def __init__(self):